@@ -9,17 +9,34 @@ This Flask application provides:
 - User profile and billing history
 """
 
+import atexit
 import os
 import sys
-import json
 import hashlib
+import hmac
+import queue
 import secrets
+import select
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from functools import wraps
-from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, session, jsonify, g, Response
+from flask_compress import Compress
 from dotenv import load_dotenv
+from cachetools import TTLCache
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerifyMismatchError
+import numpy as np
+import pandas as pd
 import psycopg2
-from psycopg2.extras import RealDictCursor
+import requests
+from requests.adapters import HTTPAdapter
+from psycopg2.extras import RealDictCursor, Json, execute_values
+from psycopg2.pool import ThreadedConnectionPool, PoolError
 import stripe
 from get_user_plan_history import UserPlanHistoryFetcher
 # Add logging imports
@@ -41,6 +58,11 @@ log_system_info(logger)
 # Configure Flask app
 app = Flask(__name__)
 app.secret_key = os.getenv('FLASK_SECRET_KEY', secrets.token_hex(32))
+Compress(app)
+
+# Background executor for overlapping Stripe round trips with database work
+app.executor = ThreadPoolExecutor(max_workers=8)
+atexit.register(app.executor.shutdown)
 
 # Configure Stripe
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
@@ -51,58 +73,555 @@ BASE_URL = os.getenv('BASE_URL', 'http://localhost:4242')
 # Database configuration
 DATABASE_URL = os.getenv('PSQL_DB_URL')
 
+# Persistent session for invoice PDF downloads; keep-alive to
+# files.stripe.com amortizes the TLS handshake across requests
+pdf_session = requests.Session()
+pdf_session.mount('https://', HTTPAdapter(pool_connections=10, pool_maxsize=50))
+
+# Shared plan-history fetcher (created lazily; psycopg2 connections are thread-safe)
+_plan_fetcher = None
+_plan_fetcher_lock = threading.Lock()
+
+def get_plan_fetcher():
+    """Get the shared UserPlanHistoryFetcher instance"""
+    global _plan_fetcher
+    if _plan_fetcher is None:
+        with _plan_fetcher_lock:
+            if _plan_fetcher is None:
+                _plan_fetcher = UserPlanHistoryFetcher()
+                atexit.register(_plan_fetcher.close)
+    return _plan_fetcher
+
+# Short-TTL cache for comprehensive plan histories, keyed by Stripe customer id
+_plan_history_cache = TTLCache(maxsize=1024, ttl=int(os.getenv('PLAN_HISTORY_CACHE_TTL', '60')))
+_plan_history_lock = threading.Lock()
+
+def cached_plan_history(stripe_customer_id):
+    """Get comprehensive plan history, served from the short-TTL cache when warm"""
+    with _plan_history_lock:
+        cached = _plan_history_cache.get(stripe_customer_id)
+    if cached is not None:
+        return cached
+
+    plan_data = get_plan_fetcher().get_comprehensive_plan_history(stripe_customer_id)
+    if 'error' not in plan_data:
+        with _plan_history_lock:
+            _plan_history_cache[stripe_customer_id] = plan_data
+    return plan_data
+
+def invalidate_plan_history(stripe_customer_id, broadcast=True):
+    """Drop cached plan history after a subscription or billing change
+
+    The cache is per-process, but gunicorn runs several workers; a NOTIFY
+    on the plan_changed channel tells the sibling workers' listener
+    threads to drop their copies too.
+    """
+    with _plan_history_lock:
+        _plan_history_cache.pop(stripe_customer_id, None)
+    if broadcast:
+        try:
+            with db_cursor(dict_rows=False) as cur:
+                cur.execute("SELECT pg_notify('plan_changed', %s)", (stripe_customer_id,))
+        except Exception as e:
+            logger.warning(f"Could not broadcast plan-history invalidation: {e}")
+
+def _plan_invalidation_listener():
+    """LISTEN for plan_changed notifications and evict the local cache
+
+    Runs on a dedicated connection outside the pool so it can block on
+    the socket without starving request handlers. Reconnects with a
+    small delay if the connection drops.
+    """
+    while True:
+        try:
+            conn = psycopg2.connect(DATABASE_URL)
+            conn.set_session(autocommit=True)
+            with conn.cursor() as cur:
+                cur.execute("LISTEN plan_changed")
+            while True:
+                if select.select([conn], [], [], 10) == ([], [], []):
+                    continue
+                conn.poll()
+                while conn.notifies:
+                    notify = conn.notifies.pop(0)
+                    invalidate_plan_history(notify.payload, broadcast=False)
+        except Exception as e:
+            logger.warning(f"Plan-history listener reconnecting: {e}")
+            time.sleep(5)
+
+def get_dashboard_bundle(stripe_customer_id):
+    """Fetch plan history once and derive the current subscription from it
+
+    Returns (plan_history, current_subscription); both None when the
+    fetch failed. Saves the separate subscription-tree traversal the
+    dashboard/profile/plans pages used to do on top of the history.
+    """
+    plan_data = cached_plan_history(stripe_customer_id)
+    if 'error' in plan_data:
+        return None, None
+    current_plans = plan_data.get('summary', {}).get('current_plans', [])
+    return plan_data, (current_plans[0] if current_plans else None)
+
+# Long-TTL cache translating price lookup keys to Stripe price ids
+_price_id_cache = TTLCache(maxsize=256, ttl=3600)
+_price_id_lock = threading.Lock()
+
+def resolve_price_id(lookup_key):
+    """Resolve a price lookup key to its Stripe price id, caching the result"""
+    with _price_id_lock:
+        price_id = _price_id_cache.get(lookup_key)
+    if price_id is not None:
+        return price_id
+
+    prices = stripe.Price.list(lookup_keys=[lookup_key], expand=['data.product'])
+    if not prices.data:
+        return None
+
+    price_id = prices.data[0].id
+    with _price_id_lock:
+        _price_id_cache[lookup_key] = price_id
+    return price_id
+
+# Invoices are immutable once finalized, so retrieved ones cache well
+_invoice_cache = TTLCache(maxsize=10_000, ttl=3600)
+_invoice_lock = threading.Lock()
+
+def get_cached_invoice(invoice_id):
+    """Retrieve a Stripe invoice, served from cache on repeat hits"""
+    with _invoice_lock:
+        invoice = _invoice_cache.get(invoice_id)
+    if invoice is not None:
+        return invoice
+
+    invoice = stripe.Invoice.retrieve(invoice_id)
+    with _invoice_lock:
+        _invoice_cache[invoice_id] = invoice
+    return invoice
+
+def invalidate_invoice(invoice_id):
+    """Drop a cached invoice after an invoice webhook touches it"""
+    with _invoice_lock:
+        _invoice_cache.pop(invoice_id, None)
+
+# Product catalog cache; /products serves from here between refreshes
+_products_cache = TTLCache(maxsize=1, ttl=300)
+_products_lock = threading.Lock()
+
+def invalidate_catalog_caches():
+    """Drop cached catalog data after a price or product change"""
+    with _products_lock:
+        _products_cache.clear()
+    with _price_id_lock:
+        _price_id_cache.clear()
+
+# Short-TTL cache for the latest-subscription lookup, keyed by email;
+# 30s is enough to absorb repeat page views without going stale
+_subscription_cache = TTLCache(maxsize=10_000, ttl=30)
+_subscription_lock = threading.Lock()
+
+def invalidate_subscription(email):
+    """Drop a cached subscription after the user changes their plan"""
+    if email:
+        with _subscription_lock:
+            _subscription_cache.pop(email.lower(), None)
+
+# Short-TTL cache for per-customer invoice listings on the billing page
+_invoice_list_cache = TTLCache(maxsize=1024, ttl=60)
+_invoice_list_lock = threading.Lock()
+
+def get_cached_invoice_list(stripe_customer_id):
+    """List a customer's Stripe invoices, served from cache on repeat hits"""
+    with _invoice_list_lock:
+        invoices = _invoice_list_cache.get(stripe_customer_id)
+    if invoices is not None:
+        return invoices
+
+    invoices = stripe.Invoice.list(customer=stripe_customer_id, limit=100)
+    with _invoice_list_lock:
+        _invoice_list_cache[stripe_customer_id] = invoices
+    return invoices
+
+def invalidate_invoice_list(stripe_customer_id):
+    """Drop a customer's cached invoice list after an invoice event"""
+    with _invoice_list_lock:
+        _invoice_list_cache.pop(stripe_customer_id, None)
+
+# Connection pool (created lazily so importing the app doesn't require a database)
+_pool = None
+_pool_lock = threading.Lock()
+# Counts free pool slots so checkout blocks when the pool is exhausted
+_pool_slots = None
+
+class OrJson(Json):
+    """psycopg2 Json adapter backed by orjson's C encoder"""
+    def dumps(self, obj):
+        return orjson.dumps(obj, default=str).decode()
+
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection subclass so per-connection flags can be attached"""
+    hot_statements_prepared = False
+
+# Hot statements are prepared once per pooled connection; EXECUTE then
+# skips the Postgres parse/plan step on every subsequent call
+_PREPARED_STATEMENTS = """
+    PREPARE get_user_by_id (int) AS
+        SELECT id, name, email, created_at, updated_at
+        FROM app_users WHERE id = $1;
+    PREPARE get_user_by_email (text) AS
+        SELECT id, email, password_hash
+        FROM app_users WHERE LOWER(email) = LOWER($1);
+    PREPARE get_cust_by_email (text) AS
+        SELECT id, stripe_id, email, name
+        FROM customers WHERE LOWER(email) = LOWER($1);
+    PREPARE upsert_customer_stmt (text, text, text, text, jsonb, text, int, text, boolean, text, jsonb, jsonb) AS
+        INSERT INTO customers (
+            stripe_id, email, name, phone, address,
+            currency, balance, tax_exempt, delinquent, invoice_prefix,
+            preferred_locales, metadata
+        ) VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12)
+        ON CONFLICT (stripe_id) DO UPDATE SET
+            email = EXCLUDED.email,
+            name = EXCLUDED.name,
+            phone = EXCLUDED.phone,
+            address = EXCLUDED.address,
+            currency = EXCLUDED.currency,
+            balance = EXCLUDED.balance,
+            tax_exempt = EXCLUDED.tax_exempt,
+            delinquent = EXCLUDED.delinquent,
+            invoice_prefix = EXCLUDED.invoice_prefix,
+            preferred_locales = EXCLUDED.preferred_locales,
+            metadata = EXCLUDED.metadata,
+            updated_at = CURRENT_TIMESTAMP
+        WHERE (customers.email, customers.name, customers.phone, customers.address,
+               customers.currency, customers.balance, customers.tax_exempt,
+               customers.delinquent, customers.invoice_prefix,
+               customers.preferred_locales, customers.metadata)
+              IS DISTINCT FROM
+              (EXCLUDED.email, EXCLUDED.name, EXCLUDED.phone, EXCLUDED.address,
+               EXCLUDED.currency, EXCLUDED.balance, EXCLUDED.tax_exempt,
+               EXCLUDED.delinquent, EXCLUDED.invoice_prefix,
+               EXCLUDED.preferred_locales, EXCLUDED.metadata)
+        RETURNING id;
+    PREPARE upsert_price_stmt (text, text, text, int, text, text, int, text, text, boolean, jsonb) AS
+        INSERT INTO prices (
+            stripe_id, product_id, currency, unit_amount, billing_scheme,
+            recurring_interval, recurring_interval_count, lookup_key, nickname,
+            active, metadata
+        ) VALUES ($1, (SELECT id FROM products WHERE stripe_id = $2), $3, $4, $5, $6, $7, $8, $9, $10, $11)
+        ON CONFLICT (stripe_id) DO UPDATE SET
+            product_id = EXCLUDED.product_id,
+            currency = EXCLUDED.currency,
+            unit_amount = EXCLUDED.unit_amount,
+            billing_scheme = EXCLUDED.billing_scheme,
+            recurring_interval = EXCLUDED.recurring_interval,
+            recurring_interval_count = EXCLUDED.recurring_interval_count,
+            lookup_key = EXCLUDED.lookup_key,
+            nickname = EXCLUDED.nickname,
+            active = EXCLUDED.active,
+            metadata = EXCLUDED.metadata
+        WHERE (prices.product_id, prices.currency, prices.unit_amount,
+               prices.billing_scheme, prices.recurring_interval,
+               prices.recurring_interval_count, prices.lookup_key,
+               prices.nickname, prices.active, prices.metadata)
+              IS DISTINCT FROM
+              (EXCLUDED.product_id, EXCLUDED.currency, EXCLUDED.unit_amount,
+               EXCLUDED.billing_scheme, EXCLUDED.recurring_interval,
+               EXCLUDED.recurring_interval_count, EXCLUDED.lookup_key,
+               EXCLUDED.nickname, EXCLUDED.active, EXCLUDED.metadata)
+        RETURNING id;
+    PREPARE store_event_stmt (text, text, text, double precision, boolean, int, text, jsonb, text) AS
+        INSERT INTO stripe_events (
+            stripe_event_id, event_type, api_version, created_at, livemode,
+            pending_webhooks, request_id, raw_data, processing_status
+        ) VALUES ($1, $2, $3, TO_TIMESTAMP($4), $5, $6, $7, $8, $9)
+        ON CONFLICT (stripe_event_id) DO NOTHING
+        RETURNING id;
+"""
+
+# Large upsert statements that are not server-side prepared are still
+# hoisted here so the strings are built once and psycopg2's statement
+# handling sees the same object on every call
+_SQL_UPSERT_SUBSCRIPTION = """
+    INSERT INTO subscriptions (
+        stripe_id, customer_id, status, current_period_start, current_period_end,
+        created_at_stripe, started_at, ended_at, canceled_at, cancel_at_period_end,
+        collection_method, currency, trial_start, trial_end, metadata
+    )
+    SELECT
+        %s, c.id, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s),
+        TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s,
+        %s, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s
+    FROM customers c
+    WHERE c.stripe_id = %s
+    ON CONFLICT (stripe_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        current_period_start = EXCLUDED.current_period_start,
+        current_period_end = EXCLUDED.current_period_end,
+        started_at = EXCLUDED.started_at,
+        ended_at = EXCLUDED.ended_at,
+        canceled_at = EXCLUDED.canceled_at,
+        cancel_at_period_end = EXCLUDED.cancel_at_period_end,
+        collection_method = EXCLUDED.collection_method,
+        currency = EXCLUDED.currency,
+        trial_start = EXCLUDED.trial_start,
+        trial_end = EXCLUDED.trial_end,
+        metadata = EXCLUDED.metadata,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING id;
+"""
+
+_SQL_UPSERT_SUBSCRIPTION_ITEMS = """
+    INSERT INTO subscription_items (
+        stripe_id, subscription_id, price_id, quantity, metadata
+    ) VALUES %s
+    ON CONFLICT (stripe_id) DO UPDATE SET
+        price_id = EXCLUDED.price_id,
+        quantity = EXCLUDED.quantity,
+        metadata = EXCLUDED.metadata
+    WHERE (subscription_items.price_id, subscription_items.quantity,
+           subscription_items.metadata)
+          IS DISTINCT FROM
+          (EXCLUDED.price_id, EXCLUDED.quantity, EXCLUDED.metadata)
+"""
+
+_SQL_UPSERT_INVOICE = """
+    INSERT INTO invoices (
+        stripe_id, customer_id, subscription_id, status, billing_reason,
+        collection_method, currency, amount_due, amount_paid, amount_remaining,
+        subtotal, total, tax_amount, created_at_stripe, due_date,
+        finalized_at, paid_at, period_start, period_end, hosted_invoice_url,
+        invoice_pdf, receipt_number, account_country, account_name,
+        attempt_count, attempted, auto_advance, metadata
+    )
+    SELECT
+        %s, c.id, (SELECT s.id FROM subscriptions s WHERE s.stripe_id = %s), %s, %s,
+        %s, %s, %s, %s, %s,
+        %s, %s, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s),
+        TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s,
+        %s, %s, %s, %s,
+        %s, %s, %s, %s
+    FROM customers c
+    WHERE c.stripe_id = %s
+    ON CONFLICT (stripe_id) DO UPDATE SET
+        status = EXCLUDED.status,
+        amount_due = EXCLUDED.amount_due,
+        amount_paid = EXCLUDED.amount_paid,
+        amount_remaining = EXCLUDED.amount_remaining,
+        subtotal = EXCLUDED.subtotal,
+        total = EXCLUDED.total,
+        tax_amount = EXCLUDED.tax_amount,
+        due_date = EXCLUDED.due_date,
+        finalized_at = EXCLUDED.finalized_at,
+        paid_at = EXCLUDED.paid_at,
+        hosted_invoice_url = EXCLUDED.hosted_invoice_url,
+        invoice_pdf = EXCLUDED.invoice_pdf,
+        receipt_number = EXCLUDED.receipt_number,
+        attempt_count = EXCLUDED.attempt_count,
+        attempted = EXCLUDED.attempted,
+        auto_advance = EXCLUDED.auto_advance,
+        metadata = EXCLUDED.metadata
+    RETURNING id;
+"""
+
+def _prepare_hot_statements(conn):
+    """Prepare the hot statements on a connection (idempotent)"""
+    if conn.hot_statements_prepared:
+        return
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_PREPARED_STATEMENTS)
+        conn.commit()
+        conn.hot_statements_prepared = True
+    except Exception as e:
+        conn.rollback()
+        db_logger.warning(f"Could not prepare hot statements: {e}")
+
+def _get_pool():
+    """Get (or create) the process-wide connection pool"""
+    global _pool, _pool_slots
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                maxconn = int(os.getenv('PG_POOL_MAX', '10'))
+                _pool_slots = threading.BoundedSemaphore(maxconn)
+                _pool = ThreadedConnectionPool(
+                    minconn=int(os.getenv('PG_POOL_MIN', '2')),
+                    maxconn=maxconn,
+                    dsn=DATABASE_URL,
+                    connection_factory=PooledConnection,
+                    cursor_factory=RealDictCursor
+                )
+                atexit.register(_pool.closeall)
+    return _pool
+
 def get_db_connection():
-    """Get database connection"""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """Check out a database connection, waiting for a free slot
+
+    getconn raises PoolError the instant maxconn connections are out,
+    which under gevent's hundreds of greenlets per worker would turn any
+    burst into 500s. The semaphore makes checkout block until a
+    connection comes back (bounded by PG_POOL_WAIT seconds); under the
+    psycogreen patch the wait yields to other greenlets.
+    """
+    pool = _get_pool()
+    if not _pool_slots.acquire(timeout=float(os.getenv('PG_POOL_WAIT', '10'))):
+        raise PoolError('timed out waiting for a database connection')
+    try:
+        conn = pool.getconn()
+    except Exception:
+        _pool_slots.release()
+        raise
+    _prepare_hot_statements(conn)
+    return conn
+
+def release_db_connection(conn):
+    """Return a database connection to the pool"""
+    try:
+        _get_pool().putconn(conn)
+    finally:
+        _pool_slots.release()
+
+@contextmanager
+def db_conn():
+    """Pooled connection context manager; commits on success, rolls back on error"""
+    conn = get_db_connection()
+    try:
+        yield conn
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        release_db_connection(conn)
+
+@contextmanager
+def db_cursor(dict_rows=True):
+    """Pooled cursor context manager for single-statement blocks
+
+    Pass dict_rows=False for tiny lookups (existence checks, single ids)
+    that never index rows by name; plain tuple cursors skip the per-row
+    dict construction RealDictCursor does.
+    """
+    with db_conn() as conn:
+        factory = RealDictCursor if dict_rows else psycopg2.extensions.cursor
+        with conn.cursor(cursor_factory=factory) as cur:
+            yield cur
+
+# Argon2id password hasher (OWASP-recommended parameters)
+password_hasher = PasswordHasher(
+    time_cost=3,
+    memory_cost=46 * 1024,  # 46 MiB
+    parallelism=2,
+    hash_len=32,
+    salt_len=16
+)
 
 def hash_password(password):
-    """Hash password with salt"""
-    salt = secrets.token_hex(32)
-    pwdhash = hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt.encode('utf-8'), 100000)
-    return salt + pwdhash.hex()
+    """Hash password with Argon2id"""
+    return password_hasher.hash(password)
 
 def verify_password(stored_password, provided_password):
-    """Verify password against stored hash"""
+    """Verify password against stored hash (Argon2id or legacy PBKDF2)"""
+    if stored_password.startswith('$argon2'):
+        try:
+            return password_hasher.verify(stored_password, provided_password)
+        except (VerifyMismatchError, InvalidHashError):
+            return False
+    return _verify_legacy_password(stored_password, provided_password)
+
+def _verify_legacy_password(stored_password, provided_password):
+    """Verify password against a legacy salted PBKDF2-HMAC-SHA256 hash"""
     salt = stored_password[:64]
     stored_hash = stored_password[64:]
     pwdhash = hashlib.pbkdf2_hmac('sha256', provided_password.encode('utf-8'), salt.encode('utf-8'), 100000)
-    return pwdhash.hex() == stored_hash
+    return hmac.compare_digest(pwdhash.hex(), stored_hash)
+
+def password_needs_rehash(stored_password):
+    """Check whether a stored hash should be upgraded to current parameters"""
+    if not stored_password.startswith('$argon2'):
+        return True
+    return password_hasher.check_needs_rehash(stored_password)
 
 def login_required(f):
     """Decorator to require login"""
+    login_url = None
+
     @wraps(f)
     def decorated_function(*args, **kwargs):
+        nonlocal login_url
         if 'user_id' not in session:
-            return redirect(url_for('login'))
+            # url_for does a full URL build; the login route is static, so
+            # build it once and reuse it on every redirect
+            if login_url is None:
+                login_url = url_for('login')
+            return redirect(login_url)
         return f(*args, **kwargs)
     return decorated_function
 
 def get_current_user():
-    """Get current logged-in user"""
+    """Get current logged-in user (cached on flask.g for the request)"""
     if 'user_id' not in session:
         return None
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT * FROM app_users WHERE id = %s", (session['user_id'],))
-        user = cur.fetchone()
-        return dict(user) if user else None
-    finally:
-        cur.close()
-        conn.close()
+
+    if 'current_user' not in g:
+        with db_cursor() as cur:
+            cur.execute("EXECUTE get_user_by_id(%s)", (session['user_id'],))
+            user = cur.fetchone()
+        g.current_user = dict(user) if user else None
+    return g.current_user
 
 def get_stripe_customer_for_user(user_email):
-    """Get Stripe customer information for user"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT * FROM customers WHERE email = %s", (user_email,))
-        customer = cur.fetchone()
-        return dict(customer) if customer else None
-    finally:
-        cur.close()
-        conn.close()
+    """Get Stripe customer information for user (cached on flask.g for the request)"""
+    cache = getattr(g, 'stripe_customer_by_email', None)
+    if cache is None:
+        cache = g.stripe_customer_by_email = {}
+
+    if user_email not in cache:
+        with db_cursor() as cur:
+            cur.execute("EXECUTE get_cust_by_email(%s)", (user_email,))
+            customer = cur.fetchone()
+        cache[user_email] = dict(customer) if customer else None
+    return cache[user_email]
+
+def get_user_and_customer():
+    """Get current user and their Stripe customer with a single JOIN query"""
+    if 'user_id' not in session:
+        return None, None
+
+    if 'current_user' not in g:
+        with db_cursor() as cur:
+            cur.execute("""
+                SELECT u.id, u.name, u.email, u.created_at, u.updated_at,
+                       c.id AS customer_db_id, c.stripe_id,
+                       c.email AS customer_email, c.name AS customer_name
+                FROM app_users u
+                LEFT JOIN customers c ON LOWER(c.email) = LOWER(u.email)
+                WHERE u.id = %s
+            """, (session['user_id'],))
+            row = cur.fetchone()
+
+        cache = getattr(g, 'stripe_customer_by_email', None)
+        if cache is None:
+            cache = g.stripe_customer_by_email = {}
+
+        if row:
+            row = dict(row)
+            g.current_user = {key: row[key] for key in ('id', 'name', 'email', 'created_at', 'updated_at')}
+            if row['stripe_id']:
+                cache[row['email']] = {
+                    'id': row['customer_db_id'],
+                    'stripe_id': row['stripe_id'],
+                    'email': row['customer_email'],
+                    'name': row['customer_name']
+                }
+            else:
+                cache[row['email']] = None
+        else:
+            g.current_user = None
+
+    user = g.current_user
+    customer = get_stripe_customer_for_user(user['email']) if user else None
+    return user, customer
 
 # Routes
 @app.route('/')
@@ -118,23 +637,28 @@ def login():
         email = request.form['email']
         password = request.form['password']
         
-        conn = get_db_connection()
-        cur = conn.cursor()
-        try:
-            cur.execute("SELECT * FROM app_users WHERE email = %s", (email,))
+        with db_cursor() as cur:
+            cur.execute("EXECUTE get_user_by_email(%s)", (email,))
             user = cur.fetchone()
-            
-            if user and verify_password(user['password_hash'], password):
-                session['user_id'] = user['id']
-                session['user_email'] = user['email']
-                flash('Login successful!', 'success')
-                return redirect(url_for('dashboard'))
-            else:
-                flash('Invalid email or password', 'error')
-        finally:
-            cur.close()
-            conn.close()
-    
+
+        if user and verify_password(user['password_hash'], password):
+            # Upgrade legacy/outdated hashes on successful login
+            if password_needs_rehash(user['password_hash']):
+                try:
+                    with db_cursor() as cur:
+                        cur.execute("UPDATE app_users SET password_hash = %s, updated_at = %s WHERE id = %s",
+                                    (hash_password(password), datetime.now(), user['id']))
+                    logger.info(f"Upgraded password hash for user {user['id']}")
+                except Exception as e:
+                    logger.warning(f"Could not upgrade password hash for user {user['id']}: {e}")
+
+            session['user_id'] = user['id']
+            session['user_email'] = user['email']
+            flash('Login successful!', 'success')
+            return redirect(url_for('dashboard'))
+        else:
+            flash('Invalid email or password', 'error')
+
     return render_template('auth/login.html')
 
 @app.route('/signup', methods=['GET', 'POST'])
@@ -150,38 +674,37 @@ def signup():
             flash('Passwords do not match', 'error')
             return render_template('auth/signup.html')
         
-        conn = get_db_connection()
-        cur = conn.cursor()
+        # Hash before taking a connection so the pool isn't held during the
+        # CPU-bound hashing step
+        password_hash = hash_password(password)
+
         try:
-            # Check if user already exists
-            cur.execute("SELECT id FROM app_users WHERE email = %s", (email,))
-            if cur.fetchone():
-                flash('Email already registered', 'error')
-                return render_template('auth/signup.html')
-            
-            # Create new user
-            password_hash = hash_password(password)
-            cur.execute("""
-                INSERT INTO app_users (name, email, password_hash, created_at)
-                VALUES (%s, %s, %s, %s)
-                RETURNING id
-            """, (name, email, password_hash, datetime.now()))
-            
-            user_id = cur.fetchone()['id']
-            conn.commit()
-            
+            with db_cursor() as cur:
+                cur.execute("""
+                    INSERT INTO app_users (name, email, password_hash, created_at)
+                    VALUES (%s, %s, %s, NOW())
+                    ON CONFLICT (email) DO NOTHING
+                    RETURNING id
+                """, (name, email, password_hash))
+
+                row = cur.fetchone()
+                if row is None:
+                    flash('Email already registered', 'error')
+                    return render_template('auth/signup.html')
+                user_id = row['id']
+
             session['user_id'] = user_id
             session['user_email'] = email
             flash('Account created successfully!', 'success')
             return redirect(url_for('dashboard'))
-            
+
+        except psycopg2.errors.UniqueViolation:
+            flash('Email already registered', 'error')
+            return render_template('auth/signup.html')
+
         except Exception as e:
-            conn.rollback()
             flash(f'Error creating account: {str(e)}', 'error')
-        finally:
-            cur.close()
-            conn.close()
-    
+
     return render_template('auth/signup.html')
 
 @app.route('/logout')
@@ -195,24 +718,14 @@ def logout():
 @login_required
 def dashboard():
     """User dashboard"""
-    user = get_current_user()
-    
-    # Get Stripe customer info and subscription history
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    # Get user and Stripe customer info in one query
+    user, stripe_customer = get_user_and_customer()
     plan_history = None
     current_subscription = None
     
     if stripe_customer:
         try:
-            # Get current subscription with latest data
-            current_subscription = load_latest_subscription_for_user(user['email'])
-            logger.info(f"Current subscription for {user['email']}: {current_subscription.get('product_name', 'None')}")
-            
-            # Get comprehensive plan history
-            fetcher = UserPlanHistoryFetcher()
-            plan_data = fetcher.get_comprehensive_plan_history(stripe_customer['stripe_id'])
-            plan_history = plan_data if 'error' not in plan_data else None
-            fetcher.close()
+            plan_history, current_subscription = get_dashboard_bundle(stripe_customer['stripe_id'])
         except Exception as e:
             logger.error(f"Error fetching dashboard data for {user['email']}: {e}")
     
@@ -225,40 +738,28 @@ def dashboard():
 @app.route('/plans')
 def plans():
     """Plans page - show available plans"""
-    user = get_current_user()
-    
+    user, stripe_customer = get_user_and_customer()
+
     # Get available plans from database
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
+    with db_cursor() as cur:
         cur.execute("""
-            SELECT p.*, pr.name as product_name, pr.description as product_description
+            SELECT p.id, p.lookup_key, p.unit_amount, p.currency, p.recurring_interval,
+                   pr.name as product_name, pr.description as product_description
             FROM prices p
             JOIN products pr ON p.product_id = pr.id
             WHERE p.active = true AND pr.active = true
             ORDER BY p.unit_amount
         """)
         available_plans = [dict(row) for row in cur.fetchall()]
-    finally:
-        cur.close()
-        conn.close()
     
     # Get user's current subscription if logged in
     current_subscription = None
-    stripe_customer = None
-    
-    if user:
-        stripe_customer = get_stripe_customer_for_user(user['email'])
-        if stripe_customer:
-            try:
-                fetcher = UserPlanHistoryFetcher()
-                plan_data = fetcher.get_comprehensive_plan_history(stripe_customer['stripe_id'])
-                if 'error' not in plan_data:
-                    current_plans = plan_data.get('summary', {}).get('current_plans', [])
-                    current_subscription = current_plans[0] if current_plans else None
-                fetcher.close()
-            except Exception as e:
-                print(f"Error fetching current subscription: {e}")
+
+    if user and stripe_customer:
+        try:
+            _, current_subscription = get_dashboard_bundle(stripe_customer['stripe_id'])
+        except Exception:
+            logger.exception("Error fetching current subscription")
     
     return render_template('plans/plans.html', 
                          user=user,
@@ -276,8 +777,7 @@ def about():
 @login_required
 def profile():
     """User profile page"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     # Get detailed plan history and current subscription
     plan_history = None
@@ -285,15 +785,7 @@ def profile():
     
     if stripe_customer:
         try:
-            # Get current subscription with latest data
-            current_subscription = load_latest_subscription_for_user(user['email'])
-            logger.info(f"Profile - Current subscription for {user['email']}: {current_subscription.get('product_name', 'None')}")
-            
-            # Get comprehensive plan history
-            fetcher = UserPlanHistoryFetcher()
-            plan_data = fetcher.get_comprehensive_plan_history(stripe_customer['stripe_id'])
-            plan_history = plan_data if 'error' not in plan_data else None
-            fetcher.close()
+            plan_history, current_subscription = get_dashboard_bundle(stripe_customer['stripe_id'])
         except Exception as e:
             logger.error(f"Error fetching profile data for {user['email']}: {e}")
     
@@ -319,63 +811,63 @@ def update_profile():
         flash('Please enter a valid email address', 'error')
         return redirect(url_for('profile'))
     
-    conn = get_db_connection()
-    cur = conn.cursor()
     try:
         # Check if email is already taken by another user
         if email != user['email']:
-            cur.execute("SELECT id FROM app_users WHERE email = %s AND id != %s", (email, user['id']))
-            if cur.fetchone():
-                flash('Email already taken by another user', 'error')
-                return redirect(url_for('profile'))
-        
-        # Update user information
-        cur.execute("""
-            UPDATE app_users 
-            SET name = %s, email = %s, updated_at = %s
-            WHERE id = %s
-        """, (name, email, datetime.now(), user['id']))
-        
-        conn.commit()
-        
+            with db_cursor(dict_rows=False) as cur:
+                cur.execute("SELECT 1 FROM app_users WHERE LOWER(email) = LOWER(%s) AND id != %s", (email, user['id']))
+                if cur.fetchone():
+                    flash('Email already taken by another user', 'error')
+                    return redirect(url_for('profile'))
+
+        with db_cursor() as cur:
+            # Update user information
+            cur.execute("""
+                UPDATE app_users
+                SET name = %s, email = %s, updated_at = %s
+                WHERE id = %s
+            """, (name, email, datetime.now(), user['id']))
+
         # Update session if email changed
         if email != user['email']:
             session['user_email'] = email
-        
+
         flash('Profile updated successfully!', 'success')
-        
+
     except Exception as e:
-        conn.rollback()
         flash(f'Error updating profile: {str(e)}', 'error')
-    finally:
-        cur.close()
-        conn.close()
-    
+
     return redirect(url_for('profile'))
 
 @app.route('/api/plan-history/<customer_id>')
 @login_required
 def api_plan_history(customer_id):
     """API endpoint to get plan history"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     # Security check - ensure user can only access their own data
     if not stripe_customer or stripe_customer['stripe_id'] != customer_id:
         return jsonify({'error': 'Unauthorized'}), 403
     
     try:
-        fetcher = UserPlanHistoryFetcher()
-        plan_data = fetcher.get_comprehensive_plan_history(customer_id)
-        fetcher.close()
-        
-        # Convert datetime objects for JSON serialization
-        def json_serializer(obj):
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
-        
-        return jsonify(plan_data)
+        plan_data = cached_plan_history(customer_id)
+
+        # orjson serializes datetimes natively and is much faster than stdlib json
+        body = orjson.dumps(plan_data, option=orjson.OPT_NAIVE_UTC | orjson.OPT_SERIALIZE_NUMPY)
+
+        # Let the browser reuse the payload while it is fresh. The ETag
+        # must be weak: Flask-Compress rewrites strong ETags on gzipped
+        # responses (appending :gzip), which would break the comparison
+        etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        if request.if_none_match.contains_weak(etag):
+            resp = Response(status=304)
+            resp.set_etag(etag, weak=True)
+            return resp
+
+        resp = Response(body, mimetype='application/json')
+        resp.set_etag(etag, weak=True)
+        resp.headers['Cache-Control'] = 'private, max-age=30'
+        return resp
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -383,15 +875,14 @@ def api_plan_history(customer_id):
 @login_required
 def get_invoice_pdf(invoice_id):
     """Get invoice PDF URL from Stripe"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     if not stripe_customer:
         return jsonify({'error': 'No Stripe customer found'}), 404
     
     try:
-        # Get the invoice from Stripe
-        invoice = stripe.Invoice.retrieve(invoice_id)
+        # Get the invoice from Stripe (cached; invoices are immutable once finalized)
+        invoice = get_cached_invoice(invoice_id)
         
         # Security check - ensure this invoice belongs to the current user
         if invoice.customer != stripe_customer['stripe_id']:
@@ -420,10 +911,12 @@ def create_checkout_session():
         return jsonify({'error': 'Missing lookup_key'}), 400
     
     try:
-        prices = stripe.Price.list(lookup_keys=[lookup_key], expand=['data.product'])
-        
+        price_id = resolve_price_id(lookup_key)
+        if not price_id:
+            return jsonify({'error': 'Unknown lookup_key'}), 400
+
         # Create or get customer
-        stripe_customer = get_stripe_customer_for_user(user['email'])
+        _, stripe_customer = get_user_and_customer()
         if stripe_customer:
             customer_id = stripe_customer['stripe_id']
         else:
@@ -433,32 +926,32 @@ def create_checkout_session():
                 name=user['name']
             )
             customer_id = customer.id
-            
+
             # Store in database
-            conn = get_db_connection()
-            cur = conn.cursor()
-            try:
+            with db_cursor() as cur:
                 cur.execute("""
                     INSERT INTO customers (stripe_id, email, name)
                     VALUES (%s, %s, %s)
+                    ON CONFLICT (stripe_id) DO UPDATE SET
+                        email = EXCLUDED.email,
+                        name = EXCLUDED.name
                 """, (customer_id, user['email'], user['name']))
-                conn.commit()
-            finally:
-                cur.close()
-                conn.close()
         
         checkout_session = stripe.checkout.Session.create(
             customer=customer_id,
             billing_address_collection='auto',
             line_items=[{
-                'price': prices.data[0].id,
+                'price': price_id,
                 'quantity': 1,
             }],
             mode='subscription',
             success_url=BASE_URL + '/success?session_id={CHECKOUT_SESSION_ID}',
             cancel_url=BASE_URL + '/cancel',
         )
-        
+
+        # Subscription state is about to change; drop stale cached history
+        invalidate_plan_history(customer_id)
+
         return redirect(checkout_session.url, code=303)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -467,8 +960,7 @@ def create_checkout_session():
 @login_required
 def create_portal_session():
     """Create Stripe customer portal session"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     if not stripe_customer:
         return jsonify({'error': 'No Stripe customer found'}), 404
@@ -486,8 +978,7 @@ def create_portal_session():
 @login_required
 def create_billing_portal_session():
     """Create a Stripe billing portal session"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     if not stripe_customer:
         flash('No billing information found', 'error')
@@ -511,30 +1002,41 @@ def create_billing_portal_session():
 @login_required
 def analytics():
     """Advanced analytics page"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     # Get detailed plan history and analytics
     analytics_data = None
     if stripe_customer:
         try:
-            fetcher = UserPlanHistoryFetcher()
-            plan_data = fetcher.get_comprehensive_plan_history(stripe_customer['stripe_id'])
+            plan_data = cached_plan_history(stripe_customer['stripe_id'])
             
             if 'error' not in plan_data:
                 # Generate additional analytics
-                analytics_data = generate_analytics_data(plan_data)
+                analytics_data = generate_analytics_data(plan_data, stripe_customer['stripe_id'])
             
-            fetcher.close()
-        except Exception as e:
-            print(f"Error fetching analytics data: {e}")
+        except Exception:
+            logger.exception("Error fetching analytics data")
     
     return render_template('dashboard/analytics.html', 
                          user=user,
                          stripe_customer=stripe_customer,
                          analytics_data=analytics_data)
 
-def generate_analytics_data(plan_data):
+def _monthly_spend_from_db(stripe_customer_id):
+    """Aggregate paid invoice totals per month directly in Postgres"""
+    with db_cursor() as cur:
+        cur.execute("""
+            SELECT to_char(date_trunc('month', i.created_at_stripe), 'YYYY-MM') AS month,
+                   SUM(i.total) / 100.0 AS amount
+            FROM invoices i
+            JOIN customers c ON c.id = i.customer_id
+            WHERE c.stripe_id = %s AND i.status = 'paid'
+            GROUP BY 1
+            ORDER BY 1
+        """, (stripe_customer_id,))
+        return cur.fetchall()
+
+def generate_analytics_data(plan_data, stripe_customer_id=None):
     """Generate analytics data from plan history"""
     analytics = {
         'monthly_spend': [],
@@ -543,42 +1045,63 @@ def generate_analytics_data(plan_data):
         'cost_trends': {},
         'recommendations': []
     }
-    
-    # Calculate monthly spending
-    from datetime import datetime, timedelta
-    from collections import defaultdict
-    
-    monthly_spend = defaultdict(float)
-    
-    # Process prorations for monthly spending
-    for proration in plan_data.get('summary', {}).get('prorations', []):
-        if proration.get('date'):
-            month_key = proration['date'].strftime('%Y-%m')
-            amount = proration.get('amount', 0)
-            if isinstance(amount, (int, float)):
-                monthly_spend[month_key] += amount / 100  # Convert from cents
-    
+
+    # Monthly spending: aggregate locally-synced invoices in SQL, falling
+    # back to the Stripe proration history when the tables are empty
+    monthly_spend = pd.Series(dtype=float)
+    if stripe_customer_id:
+        try:
+            monthly_rows = _monthly_spend_from_db(stripe_customer_id)
+            monthly_spend = pd.Series(
+                {row['month']: float(row['amount']) for row in monthly_rows}
+            )
+        except Exception as e:
+            logger.warning(f"Monthly spend SQL aggregation failed, using prorations: {e}")
+
+    if monthly_spend.empty:
+        prorations = plan_data.get('summary', {}).get('prorations', [])
+        if prorations:
+            df = pd.DataFrame(prorations)
+            df['amount'] = pd.to_numeric(df.get('amount'), errors='coerce') / 100  # Convert from cents
+            df['month'] = pd.to_datetime(df.get('date'), errors='coerce').dt.strftime('%Y-%m')
+            df = df.dropna(subset=['amount', 'month'])
+            monthly_spend = df.groupby('month', sort=True)['amount'].sum()
+
     # Convert to list format for charts
     analytics['monthly_spend'] = [
-        {'month': month, 'amount': amount} 
-        for month, amount in sorted(monthly_spend.items())
+        {'month': month, 'amount': float(amount)}
+        for month, amount in monthly_spend.items()
     ]
-    
-    # Plan changes timeline
-    for change in plan_data.get('summary', {}).get('plan_changes', []):
-        analytics['plan_changes_timeline'].append({
-            'date': change.get('timestamp'),
-            'from_plan': change.get('from_plan', {}).get('product_name', 'None'),
-            'to_plan': change.get('to_plan', {}).get('product_name', 'Unknown'),
-            'reason': 'upgrade' if change.get('to_plan', {}).get('unit_amount', 0) > change.get('from_plan', {}).get('unit_amount', 0) else 'downgrade'
+
+    # Plan changes timeline, classified with one vectorized comparison
+    plan_changes = plan_data.get('summary', {}).get('plan_changes', [])
+    if plan_changes:
+        changes = pd.json_normalize(plan_changes)
+
+        def _column(name, default):
+            series = changes.get(name)
+            if series is None:
+                series = pd.Series([default] * len(changes), index=changes.index)
+            return series if default is None else series.fillna(default)
+
+        timeline = pd.DataFrame({
+            'date': _column('timestamp', None),
+            'from_plan': _column('from_plan.product_name', 'None'),
+            'to_plan': _column('to_plan.product_name', 'Unknown'),
+            'reason': np.where(
+                pd.to_numeric(_column('to_plan.unit_amount', 0), errors='coerce').fillna(0)
+                > pd.to_numeric(_column('from_plan.unit_amount', 0), errors='coerce').fillna(0),
+                'upgrade', 'downgrade'
+            )
         })
+        analytics['plan_changes_timeline'] = timeline.to_dict('records')
     
     # Usage metrics
     analytics['usage_metrics'] = {
         'total_subscription_days': (datetime.now() - plan_data.get('summary', {}).get('customer_created', datetime.now())).days,
         'plan_changes_count': len(plan_data.get('summary', {}).get('plan_changes', [])),
-        'average_monthly_cost': sum(monthly_spend.values()) / max(len(monthly_spend), 1),
-        'total_lifetime_value': sum(monthly_spend.values())
+        'average_monthly_cost': float(monthly_spend.mean()) if not monthly_spend.empty else 0.0,
+        'total_lifetime_value': float(monthly_spend.sum())
     }
     
     # Simple recommendations
@@ -602,6 +1125,11 @@ def generate_analytics_data(plan_data):
 @app.route('/products', methods=['GET'])
 def get_products():
     try:
+        with _products_lock:
+            cached = _products_cache.get('products')
+        if cached is not None:
+            return jsonify(cached)
+
         prices = stripe.Price.list(active=True, expand=["data.product"])
         products = []
         for price in prices.data:
@@ -616,6 +1144,9 @@ def get_products():
                 "interval": price.recurring["interval"] if price.recurring else None,
                 "description": product.get("description", "")
             })
+
+        with _products_lock:
+            _products_cache['products'] = products
         return jsonify(products)
     except Exception as e:
         logger.error(f"Error fetching products: {e}")
@@ -630,12 +1161,9 @@ def cancel_subscription():
         return jsonify({'error': 'No active subscription found'}), 400
     try:
         stripe.Subscription.delete(sub['stripe_id'])
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute("UPDATE subscriptions SET status = 'canceled', canceled_at = CURRENT_TIMESTAMP WHERE stripe_id = %s", (sub['stripe_id'],))
-        conn.commit()
-        cur.close()
-        conn.close()
+        with db_cursor() as cur:
+            cur.execute("UPDATE subscriptions SET status = 'canceled', canceled_at = CURRENT_TIMESTAMP WHERE stripe_id = %s", (sub['stripe_id'],))
+        invalidate_subscription(user_id)
         return redirect(url_for('checkout_cancel'))
     except Exception as e:
         logger.error(f"Cancel subscription error: {e}")
@@ -650,9 +1178,13 @@ def update_subscription():
     if not sub or 'id' not in sub:
         return jsonify({'error': 'No active subscription'}), 400
     try:
-        prices = stripe.Price.list(lookup_keys=[lookup_key], expand=['data.product'])
-        new_price_id = prices.data[0].id
+        # Price resolution and subscription retrieval are independent
+        # Stripe calls; overlap them on the shared executor
+        price_future = app.executor.submit(resolve_price_id, lookup_key)
         subscription = stripe.Subscription.retrieve(sub['stripe_id'])
+        new_price_id = price_future.result(timeout=5)
+        if not new_price_id:
+            return jsonify({'error': 'Unknown lookup_key'}), 400
         item_id = subscription['items']['data'][0]['id']
         stripe.Subscription.modify(
             sub['stripe_id'],
@@ -660,6 +1192,7 @@ def update_subscription():
             proration_behavior='create_prorations',
             items=[{'id': item_id, 'price': new_price_id}]
         )
+        invalidate_subscription(user_id)
         return redirect(url_for('checkout_success'))
     except Exception as e:
         logger.error(f"Update subscription error: {e}")
@@ -707,58 +1240,34 @@ def upsert_customer(data, conn, cur):
         address = data.get('address', {}) or {}
         db_logger.debug(f"Customer {customer_id} address data: {address}")
         
+        # Runs the statement prepared once per pooled connection
         cur.execute("""
-            INSERT INTO customers (
-                stripe_id, email, name, phone, address_line1, address_line2,
-                address_city, address_state, address_postal_code, address_country,
-                currency, balance, tax_exempt, delinquent, invoice_prefix,
-                preferred_locales, metadata
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (stripe_id) DO UPDATE SET
-                email = EXCLUDED.email,
-                name = EXCLUDED.name,
-                phone = EXCLUDED.phone,
-                address_line1 = EXCLUDED.address_line1,
-                address_line2 = EXCLUDED.address_line2,
-                address_city = EXCLUDED.address_city,
-                address_state = EXCLUDED.address_state,
-                address_postal_code = EXCLUDED.address_postal_code,
-                address_country = EXCLUDED.address_country,
-                currency = EXCLUDED.currency,
-                balance = EXCLUDED.balance,
-                tax_exempt = EXCLUDED.tax_exempt,
-                delinquent = EXCLUDED.delinquent,
-                invoice_prefix = EXCLUDED.invoice_prefix,
-                preferred_locales = EXCLUDED.preferred_locales,
-                metadata = EXCLUDED.metadata,
-                updated_at = CURRENT_TIMESTAMP
-            RETURNING id;
+            EXECUTE upsert_customer_stmt(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """, (
             customer_id,
             data.get('email', ''),
             data.get('name', ''),
             data.get('phone', ''),
-            address.get('line1', ''),
-            address.get('line2', ''),
-            address.get('city', ''),
-            address.get('state', ''),
-            address.get('postal_code', ''),
-            address.get('country', ''),
+            OrJson(address),
             data.get('currency', ''),
             data.get('balance', 0),
             data.get('tax_exempt', 'none'),
             data.get('delinquent', False),
             data.get('invoice_prefix', ''),
-            json.dumps(data.get('preferred_locales', [])),
-            json.dumps(data.get('metadata', {}))
+            OrJson(data.get('preferred_locales', [])),
+            OrJson(data.get('metadata', {}))
         ))
         
         result = cur.fetchone()
+        if result is None:
+            # No-op update skipped by the IS DISTINCT FROM guard (replay)
+            db_logger.debug(f"Customer {customer_id} unchanged, update skipped")
+            return None
         db_id = result['id']
-        
+
         db_logger.info(f"Successfully upserted customer {customer_id} with database ID: {db_id}")
         logger.debug(f"Customer upsert completed: Stripe ID {customer_id} -> DB ID {db_id}")
-        
+
         return db_id
         
     except psycopg2.Error as e:
@@ -784,19 +1293,26 @@ def upsert_product(data, conn, cur):
                 description = EXCLUDED.description,
                 active = EXCLUDED.active,
                 metadata = EXCLUDED.metadata
+            WHERE (products.name, products.description, products.active, products.metadata)
+                  IS DISTINCT FROM
+                  (EXCLUDED.name, EXCLUDED.description, EXCLUDED.active, EXCLUDED.metadata)
             RETURNING id;
         """, (
             stripe_id,
             data.get('name', ''),
             data.get('description', ''),
             data.get('active', True),
-            json.dumps(data.get('metadata', {}))
+            OrJson(data.get('metadata', {}))
         ))
         
         result = cur.fetchone()
+        if result is None:
+            # No-op update skipped by the IS DISTINCT FROM guard (replay)
+            db_logger.debug(f"Product {stripe_id} unchanged, update skipped")
+            return None
         db_logger.info(f"Upserted product {stripe_id} -> DB ID {result['id']}")
         return result['id']
-        
+
     except Exception as e:
         db_logger.error(f"Error upserting product {stripe_id}: {e}")
         raise
@@ -805,39 +1321,16 @@ def upsert_price(data, conn, cur):
     """Upsert price from Stripe event"""
     stripe_id = data.get('id')
     product_stripe_id = data.get('product')
-    
-    # Get product database ID
-    product_id = None
-    if product_stripe_id:
-        cur.execute("SELECT id FROM products WHERE stripe_id = %s", (product_stripe_id,))
-        row = cur.fetchone()
-        if row:
-            product_id = row['id']
-    
+
     try:
         recurring = data.get('recurring', {}) or {}
-        
+
+        # Runs the prepared statement; the product FK resolves server-side
         cur.execute("""
-            INSERT INTO prices (
-                stripe_id, product_id, currency, unit_amount, billing_scheme,
-                recurring_interval, recurring_interval_count, lookup_key, nickname,
-                active, metadata
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            ON CONFLICT (stripe_id) DO UPDATE SET
-                product_id = EXCLUDED.product_id,
-                currency = EXCLUDED.currency,
-                unit_amount = EXCLUDED.unit_amount,
-                billing_scheme = EXCLUDED.billing_scheme,
-                recurring_interval = EXCLUDED.recurring_interval,
-                recurring_interval_count = EXCLUDED.recurring_interval_count,
-                lookup_key = EXCLUDED.lookup_key,
-                nickname = EXCLUDED.nickname,
-                active = EXCLUDED.active,
-                metadata = EXCLUDED.metadata
-            RETURNING id;
+            EXECUTE upsert_price_stmt(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
         """, (
             stripe_id,
-            product_id,
+            product_stripe_id,
             data.get('currency', '').upper(),
             data.get('unit_amount'),
             data.get('billing_scheme', 'per_unit'),
@@ -846,13 +1339,17 @@ def upsert_price(data, conn, cur):
             data.get('lookup_key'),
             data.get('nickname'),
             data.get('active', True),
-            json.dumps(data.get('metadata', {}))
+            OrJson(data.get('metadata', {}))
         ))
         
         result = cur.fetchone()
+        if result is None:
+            # No-op update skipped by the IS DISTINCT FROM guard (replay)
+            db_logger.debug(f"Price {stripe_id} unchanged, update skipped")
+            return None
         db_logger.info(f"Upserted price {stripe_id} -> DB ID {result['id']}")
         return result['id']
-        
+
     except Exception as e:
         db_logger.error(f"Error upserting price {stripe_id}: {e}")
         raise
@@ -861,48 +1358,12 @@ def upsert_subscription_new(data, conn, cur):
     """Upsert subscription using new schema"""
     stripe_id = data.get('id')
     customer_stripe_id = data.get('customer')
-    
-    # Get customer database ID
-    customer_id = None
-    if customer_stripe_id:
-        cur.execute("SELECT id FROM customers WHERE stripe_id = %s", (customer_stripe_id,))
-        row = cur.fetchone()
-        if row:
-            customer_id = row['id']
-    
-    if not customer_id:
-        db_logger.error(f"Cannot upsert subscription: customer not found for {customer_stripe_id}")
-        return None
-    
+
     try:
-        cur.execute("""
-            INSERT INTO subscriptions (
-                stripe_id, customer_id, status, current_period_start, current_period_end,
-                created_at_stripe, started_at, ended_at, canceled_at, cancel_at_period_end,
-                collection_method, currency, trial_start, trial_end, metadata
-            ) VALUES (
-                %s, %s, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s),
-                TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s,
-                %s, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s
-            )
-            ON CONFLICT (stripe_id) DO UPDATE SET
-                status = EXCLUDED.status,
-                current_period_start = EXCLUDED.current_period_start,
-                current_period_end = EXCLUDED.current_period_end,
-                started_at = EXCLUDED.started_at,
-                ended_at = EXCLUDED.ended_at,
-                canceled_at = EXCLUDED.canceled_at,
-                cancel_at_period_end = EXCLUDED.cancel_at_period_end,
-                collection_method = EXCLUDED.collection_method,
-                currency = EXCLUDED.currency,
-                trial_start = EXCLUDED.trial_start,
-                trial_end = EXCLUDED.trial_end,
-                metadata = EXCLUDED.metadata,
-                updated_at = CURRENT_TIMESTAMP
-            RETURNING id;
-        """, (
+        # Resolve the customer FK inline; no rows means the customer is
+        # not synced yet and nothing is inserted
+        cur.execute(_SQL_UPSERT_SUBSCRIPTION, (
             stripe_id,
-            customer_id,
             data.get('status'),
             data.get('current_period_start'),
             data.get('current_period_end'),
@@ -915,39 +1376,39 @@ def upsert_subscription_new(data, conn, cur):
             data.get('currency'),
             data.get('trial_start'),
             data.get('trial_end'),
-            json.dumps(data.get('metadata', {}))
+            OrJson(data.get('metadata', {})),
+            customer_stripe_id
         ))
         
         result = cur.fetchone()
+        if result is None:
+            db_logger.error(f"Cannot upsert subscription: customer not found for {customer_stripe_id}")
+            return None
         subscription_db_id = result['id']
-        
-        # Handle subscription items
+
+        # Handle subscription items: resolve all price FKs in one query,
+        # then upsert every item in one multi-row statement
         items = data.get('items', {}).get('data', [])
-        for item in items:
-            price_stripe_id = item.get('price', {}).get('id')
-            if price_stripe_id:
-                # Get price database ID
-                cur.execute("SELECT id FROM prices WHERE stripe_id = %s", (price_stripe_id,))
-                price_row = cur.fetchone()
-                if price_row:
-                    price_db_id = price_row['id']
-                    
-                    # Upsert subscription item
-                    cur.execute("""
-                        INSERT INTO subscription_items (
-                            stripe_id, subscription_id, price_id, quantity, metadata
-                        ) VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (stripe_id) DO UPDATE SET
-                            price_id = EXCLUDED.price_id,
-                            quantity = EXCLUDED.quantity,
-                            metadata = EXCLUDED.metadata
-                    """, (
-                        item.get('id'),
-                        subscription_db_id,
-                        price_db_id,
-                        item.get('quantity', 1),
-                        json.dumps(item.get('metadata', {}))
-                    ))
+        price_stripe_ids = [item.get('price', {}).get('id') for item in items
+                            if item.get('price', {}).get('id')]
+        if price_stripe_ids:
+            cur.execute("SELECT id, stripe_id FROM prices WHERE stripe_id = ANY(%s)",
+                        (price_stripe_ids,))
+            price_map = {row['stripe_id']: row['id'] for row in cur.fetchall()}
+
+            rows = [
+                (
+                    item.get('id'),
+                    subscription_db_id,
+                    price_map[item['price']['id']],
+                    item.get('quantity', 1),
+                    OrJson(item.get('metadata', {}))
+                )
+                for item in items
+                if item.get('price', {}).get('id') in price_map
+            ]
+            if rows:
+                execute_values(cur, _SQL_UPSERT_SUBSCRIPTION_ITEMS, rows, page_size=500)
         
         db_logger.info(f"Upserted subscription {stripe_id} -> DB ID {subscription_db_id}")
         return subscription_db_id
@@ -962,59 +1423,12 @@ def upsert_invoice_new(data, conn, cur):
     customer_stripe_id = data.get('customer')
     subscription_stripe_id = data.get('subscription')
     
-    # Get foreign key IDs
-    customer_id = None
-    if customer_stripe_id:
-        cur.execute("SELECT id FROM customers WHERE stripe_id = %s", (customer_stripe_id,))
-        row = cur.fetchone()
-        if row:
-            customer_id = row['id']
-    
-    subscription_id = None
-    if subscription_stripe_id:
-        cur.execute("SELECT id FROM subscriptions WHERE stripe_id = %s", (subscription_stripe_id,))
-        row = cur.fetchone()
-        if row:
-            subscription_id = row['id']
-    
     try:
-        cur.execute("""
-            INSERT INTO invoices (
-                stripe_id, customer_id, subscription_id, status, billing_reason,
-                collection_method, currency, amount_due, amount_paid, amount_remaining,
-                subtotal, total, tax_amount, created_at_stripe, due_date,
-                finalized_at, paid_at, period_start, period_end, hosted_invoice_url,
-                invoice_pdf, receipt_number, account_country, account_name,
-                attempt_count, attempted, auto_advance, metadata
-            ) VALUES (
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, %s, %s,
-                %s, %s, %s, TO_TIMESTAMP(%s), TO_TIMESTAMP(%s),
-                TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), TO_TIMESTAMP(%s), %s,
-                %s, %s, %s, %s,
-                %s, %s, %s, %s
-            )
-            ON CONFLICT (stripe_id) DO UPDATE SET
-                status = EXCLUDED.status,
-                amount_due = EXCLUDED.amount_due,
-                amount_paid = EXCLUDED.amount_paid,
-                amount_remaining = EXCLUDED.amount_remaining,
-                subtotal = EXCLUDED.subtotal,
-                total = EXCLUDED.total,
-                tax_amount = EXCLUDED.tax_amount,
-                due_date = EXCLUDED.due_date,
-                finalized_at = EXCLUDED.finalized_at,
-                paid_at = EXCLUDED.paid_at,
-                hosted_invoice_url = EXCLUDED.hosted_invoice_url,
-                invoice_pdf = EXCLUDED.invoice_pdf,
-                receipt_number = EXCLUDED.receipt_number,
-                attempt_count = EXCLUDED.attempt_count,
-                attempted = EXCLUDED.attempted,
-                auto_advance = EXCLUDED.auto_advance,
-                metadata = EXCLUDED.metadata
-            RETURNING id;
-        """, (
-            stripe_id, customer_id, subscription_id, data.get('status'), data.get('billing_reason'),
+        # Both FK lookups fold into the statement: the customer join is
+        # required (no row means the customer is not synced yet) and the
+        # subscription resolves via a nullable scalar subquery
+        cur.execute(_SQL_UPSERT_INVOICE, (
+            stripe_id, subscription_stripe_id, data.get('status'), data.get('billing_reason'),
             data.get('collection_method'), data.get('currency', '').upper(),
             data.get('amount_due', 0), data.get('amount_paid', 0), data.get('amount_remaining', 0),
             data.get('subtotal', 0), data.get('total', 0), data.get('tax', 0),
@@ -1026,10 +1440,14 @@ def upsert_invoice_new(data, conn, cur):
             data.get('receipt_number'), data.get('account_country'),
             data.get('account_name'), data.get('attempt_count', 0),
             data.get('attempted', False), data.get('auto_advance', False),
-            json.dumps(data.get('metadata', {}))
+            OrJson(data.get('metadata', {})),
+            customer_stripe_id
         ))
-        
+
         result = cur.fetchone()
+        if result is None:
+            db_logger.error(f"Cannot upsert invoice {stripe_id}: customer not found for {customer_stripe_id}")
+            return None
         db_logger.info(f"Upserted invoice {stripe_id} -> DB ID {result['id']}")
         return result['id']
         
@@ -1038,17 +1456,20 @@ def upsert_invoice_new(data, conn, cur):
         raise
 
 def store_stripe_event(event, conn, cur):
-    """Store raw Stripe event for audit purposes"""
+    """Store raw Stripe event for audit purposes
+
+    Returns False when the event was already stored (Stripe redelivery),
+    so callers can skip reprocessing it. Does NOT commit: the caller
+    commits after the handler succeeds, so a failed handler rolls the
+    audit row back too and the redelivery is not mistaken for a
+    duplicate.
+    """
     event_id = event.get('id', 'unknown')
     event_type = event.get('type', 'unknown')
-    
+
     try:
         cur.execute("""
-            INSERT INTO stripe_events (
-                stripe_event_id, event_type, api_version, created_at, livemode,
-                pending_webhooks, request_id, raw_data, processing_status
-            ) VALUES (%s, %s, %s, TO_TIMESTAMP(%s), %s,
-                %s, %s, %s, %s)
+            EXECUTE store_event_stmt(%s, %s, %s, %s, %s, %s, %s, %s, %s)
             """, (
                 event_id,
                 event_type,
@@ -1057,24 +1478,34 @@ def store_stripe_event(event, conn, cur):
                 event.get('livemode', False),
                 event.get('pending_webhooks', 0),
                 event.get('request', {}).get('id', ''),
-                json.dumps(event),
+                OrJson(dict(event)),
                 'pending'
             ))
-        
-        conn.commit()
-        logger.info(f"Stored Stripe event {event_id} of type {event_type}")
+
+        inserted = cur.fetchone() is not None
+        if inserted:
+            logger.info(f"Stored Stripe event {event_id} of type {event_type}")
+        return inserted
     except Exception as e:
         conn.rollback()
         logger.error(f"Error storing Stripe event {event_id}: {e}")
+        # Fail open: better to reprocess an event than to drop one
+        return True
 
 # Helper functions for Stripe integration
 def load_latest_subscription_for_user(email):
     """Load latest subscription for user with proper SQL query and sync with Stripe"""
+    cache_key = email.lower()
+    with _subscription_lock:
+        cached = _subscription_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     conn = get_db_connection()
     cur = conn.cursor()
     try:
         # First get the customer
-        cur.execute("SELECT stripe_id FROM customers WHERE email = %s", (email,))
+        cur.execute("SELECT stripe_id FROM customers WHERE LOWER(email) = LOWER(%s)", (email,))
         customer_row = cur.fetchone()
         
         if not customer_row:
@@ -1082,7 +1513,7 @@ def load_latest_subscription_for_user(email):
             return {}
         
         customer_stripe_id = customer_row['stripe_id']
-        
+
         # Get active subscription from Stripe to ensure we have the latest data
         try:
             stripe_subscriptions = stripe.Subscription.list(
@@ -1090,17 +1521,45 @@ def load_latest_subscription_for_user(email):
                 status='active',
                 limit=1
             )
-            
+
             if stripe_subscriptions.data:
                 # Sync the subscription data with our database
                 latest_stripe_sub = stripe_subscriptions.data[0]
-                upsert_subscription_new(latest_stripe_sub, conn, cur)
+                subscription_db_id = upsert_subscription_new(latest_stripe_sub, conn, cur)
                 conn.commit()
                 logger.info(f"Synced subscription data for customer {customer_stripe_id}")
+
+                # We already hold the freshest copy in memory, so build the
+                # result from it instead of re-reading via the 4-way JOIN;
+                # only the product name needs a single indexed lookup
+                if subscription_db_id is not None:
+                    items = latest_stripe_sub.get('items', {}).get('data', [])
+                    price = items[0].get('price', {}) if items else {}
+                    product_name = None
+                    if price.get('product'):
+                        cur.execute("SELECT name FROM products WHERE stripe_id = %s",
+                                    (price['product'],))
+                        product_row = cur.fetchone()
+                        product_name = product_row['name'] if product_row else None
+                    result = {
+                        'id': subscription_db_id,
+                        'stripe_id': latest_stripe_sub['id'],
+                        'status': latest_stripe_sub.get('status'),
+                        'currency': latest_stripe_sub.get('currency'),
+                        'email': email,
+                        'lookup_key': price.get('lookup_key'),
+                        'unit_amount': price.get('unit_amount'),
+                        'price_nickname': price.get('nickname'),
+                        'product_name': product_name,
+                    }
+                    logger.info(f"Retrieved subscription for {email}: {product_name or 'Unknown'}")
+                    with _subscription_lock:
+                        _subscription_cache[cache_key] = result
+                    return result
         except Exception as stripe_error:
             logger.error(f"Error fetching subscription from Stripe: {stripe_error}")
-        
-        # Now query our database for the subscription
+
+        # Fall back to our database when Stripe had nothing (or errored)
         cur.execute("""
             SELECT s.*, c.email, p.lookup_key, p.unit_amount, pr.name as product_name,
                    p.nickname as price_nickname
@@ -1109,7 +1568,7 @@ def load_latest_subscription_for_user(email):
             LEFT JOIN subscription_items si ON s.id = si.subscription_id
             LEFT JOIN prices p ON si.price_id = p.id
             LEFT JOIN products pr ON p.product_id = pr.id
-            WHERE c.email = %s AND s.status = 'active'
+            WHERE LOWER(c.email) = LOWER(%s) AND s.status = 'active'
             ORDER BY s.updated_at DESC 
             LIMIT 1;
         """, (email,))
@@ -1117,6 +1576,8 @@ def load_latest_subscription_for_user(email):
         if row:
             result = dict(row)
             logger.info(f"Retrieved subscription for {email}: {result.get('product_name', 'Unknown')}")
+            with _subscription_lock:
+                _subscription_cache[cache_key] = result
             return result
         else:
             logger.warning(f"No active subscription found for {email}")
@@ -1126,7 +1587,7 @@ def load_latest_subscription_for_user(email):
         return {}
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def get_current_user_id():
     """Get current user ID for compatibility with server.py functions"""
@@ -1172,6 +1633,24 @@ def send_test_email():
     
     return redirect(url_for('profile'))
 
+def _tail_lines(path, n):
+    """Read the last n lines of a file by seeking backwards in 64KB blocks"""
+    block_size = 64 * 1024
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        remaining = f.tell()
+        chunks = []
+        newlines = 0
+        while remaining > 0 and newlines <= n:
+            read_size = min(block_size, remaining)
+            remaining -= read_size
+            f.seek(remaining)
+            chunk = f.read(read_size)
+            newlines += chunk.count(b'\n')
+            chunks.append(chunk)
+    data = b''.join(reversed(chunks)).decode('utf-8', errors='replace')
+    return data.splitlines(keepends=True)[-n:]
+
 # Add a route to display logs
 @app.route('/logs')
 @login_required
@@ -1182,12 +1661,11 @@ def logs():
     if user['role'] != 'admin':
         flash('You do not have permission to view logs', 'error')
         return redirect(url_for('index'))
-    
-    # Read and display logs
+
+    # Read and display only the tail of the log, not the whole file
     try:
-        with open('app.log', 'r') as f:
-            log_data = f.readlines()
-        
+        log_data = _tail_lines('app.log', 500)
+
         # Render logs in a preformatted text block
         return render_template('logs.html', logs=log_data)
     except Exception as e:
@@ -1221,14 +1699,13 @@ def clear_logs():
 @login_required
 def billing_history():
     """View billing history for the logged-in user"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     invoices = []
     if stripe_customer:
         try:
-            # List all invoices for the customer
-            invoices = stripe.Invoice.list(customer=stripe_customer['stripe_id'], limit=100)
+            # List all invoices for the customer (cached for repeat views)
+            invoices = get_cached_invoice_list(stripe_customer['stripe_id'])
         except Exception as e:
             logger.error(f"Error fetching invoices for customer {stripe_customer['stripe_id']}: {e}")
             flash('Error fetching invoices. Please try again later.', 'error')
@@ -1240,14 +1717,13 @@ def billing_history():
 @login_required
 def view_invoice(invoice_id):
     """View details of a specific invoice"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     invoice = None
     if stripe_customer:
         try:
-            # Retrieve the invoice from Stripe
-            invoice = stripe.Invoice.retrieve(invoice_id)
+            # Retrieve the invoice from Stripe (cached)
+            invoice = get_cached_invoice(invoice_id)
             
             # Security check - ensure this invoice belongs to the current user
             if invoice.customer != stripe_customer['stripe_id']:
@@ -1263,15 +1739,14 @@ def view_invoice(invoice_id):
 @login_required
 def download_invoice_pdf(invoice_id):
     """Download invoice PDF from Stripe"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     if not stripe_customer:
         return jsonify({'error': 'No Stripe customer found'}), 404
     
     try:
-        # Get the invoice from Stripe
-        invoice = stripe.Invoice.retrieve(invoice_id)
+        # Get the invoice from Stripe (cached; invoices are immutable once finalized)
+        invoice = get_cached_invoice(invoice_id)
         
         # Security check - ensure this invoice belongs to the current user
         if invoice.customer != stripe_customer['stripe_id']:
@@ -1282,17 +1757,19 @@ def download_invoice_pdf(invoice_id):
         if not pdf_url:
             return jsonify({'error': 'PDF not available for this invoice'}), 404
         
-        # Download the PDF file
-        import requests
-        response = requests.get(pdf_url)
+        # Stream the PDF straight through to the client instead of buffering
+        # the whole body in memory; the first chunk goes out while the rest
+        # is still downloading from Stripe
+        from flask import stream_with_context
+        response = pdf_session.get(pdf_url, stream=True, timeout=(3.05, 30))
         response.raise_for_status()  # Raise an error for bad responses
-        
-        # Send the PDF file as a response
-        from flask import send_file
-        from io import BytesIO
-        return send_file(BytesIO(response.content), 
-                         attachment_filename=f"invoice_{invoice_id}.pdf", 
-                         as_attachment=True)
+
+        headers = {'Content-Disposition': f'attachment; filename=invoice_{invoice_id}.pdf'}
+        if response.headers.get('Content-Length'):
+            headers['Content-Length'] = response.headers['Content-Length']
+        return Response(stream_with_context(response.iter_content(chunk_size=64 * 1024)),
+                        mimetype='application/pdf',
+                        headers=headers)
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -1301,8 +1778,7 @@ def download_invoice_pdf(invoice_id):
 @login_required
 def update_payment_method():
     """Update payment method for the logged-in user"""
-    user = get_current_user()
-    stripe_customer = get_stripe_customer_for_user(user['email'])
+    user, stripe_customer = get_user_and_customer()
     
     if not stripe_customer:
         return jsonify({'error': 'No Stripe customer found'}), 404
@@ -1330,14 +1806,141 @@ def update_payment_method():
     
     return redirect(url_for('profile'))
 
+def _apply_webhook_event(event, conn, cur):
+    """Dispatch a single verified, deduplicated Stripe event to its handler"""
+    # Handle different event types
+    if event['type'] == 'customer.created':
+        upsert_customer(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'customer.updated':
+        upsert_customer(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'customer.deleted':
+        # Soft delete the customer in the database
+        cur.execute("""
+            UPDATE customers
+            SET deleted_at = %s
+            WHERE stripe_id = %s
+        """, (datetime.now(), event['data']['object']['id']))
+
+    elif event['type'] == 'subscription.created':
+        upsert_subscription_new(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'subscription.updated':
+        upsert_subscription_new(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'subscription.deleted':
+        # Soft delete the subscription in the database
+        cur.execute("""
+            UPDATE subscriptions
+            SET canceled_at = %s, status = 'canceled'
+            WHERE stripe_id = %s
+        """, (datetime.now(), event['data']['object']['id']))
+
+    elif event['type'] == 'invoice.created':
+        upsert_invoice_new(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'invoice.updated':
+        upsert_invoice_new(event['data']['object'], conn, cur)
+
+    elif event['type'] == 'invoice.payment_succeeded':
+        # Update invoice status to paid
+        cur.execute("""
+            UPDATE invoices
+            SET status = 'paid', paid_at = %s
+            WHERE stripe_id = %s
+        """, (datetime.now(), event['data']['object']['id']))
+
+    elif event['type'] == 'invoice.payment_failed':
+        # Update invoice status to unpaid
+        cur.execute("""
+            UPDATE invoices
+            SET status = 'unpaid'
+            WHERE stripe_id = %s
+        """, (event['data']['object']['id'],))
+
+    # Catalog changes invalidate the product/price caches
+    if event['type'].startswith(('price.', 'product.', 'plan.')):
+        invalidate_catalog_caches()
+
+    # Invoice events refresh the cached copy of that invoice
+    if event['type'].startswith('invoice.'):
+        invalidate_invoice(event['data']['object'].get('id'))
+
+    # Drop any cached plan history and listings touched by this event
+    event_object = event['data']['object']
+    customer_ref = event_object.get('customer')
+    if not customer_ref and event['type'].startswith('customer.'):
+        customer_ref = event_object.get('id')
+    if customer_ref:
+        invalidate_plan_history(customer_ref)
+        if event['type'].startswith('invoice.'):
+            invalidate_invoice_list(customer_ref)
+    # Customer events carry the email, which keys the subscription cache
+    invalidate_subscription(event_object.get('email'))
+
+# Verified events are buffered here and applied by a background worker, so
+# the webhook route can ack immediately and replay storms are absorbed by
+# batched flushes instead of one connection checkout per delivery
+_webhook_queue = queue.Queue(maxsize=10_000)
+_WEBHOOK_BATCH_MAX = 100
+_WEBHOOK_BATCH_WINDOW = 0.1  # seconds to wait for more events before flushing
+
+def _drain_webhook_batch():
+    """Block for one event, then collect more for up to the batch window"""
+    batch = [_webhook_queue.get()]
+    deadline = time.monotonic() + _WEBHOOK_BATCH_WINDOW
+    while len(batch) < _WEBHOOK_BATCH_MAX:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(_webhook_queue.get(timeout=remaining))
+        except queue.Empty:
+            break
+    return batch
+
+def _webhook_worker():
+    """Drain queued events in batches, sharing one connection per flush"""
+    while True:
+        batch = _drain_webhook_batch()
+        try:
+            with db_conn() as conn:
+                for event in batch:
+                    try:
+                        with conn.cursor() as cur:
+                            # stripe_events.stripe_event_id is unique, so a
+                            # conflict means we already processed this event
+                            if not store_stripe_event(event, conn, cur):
+                                logger.info(f"Skipping duplicate event {event['id']}")
+                                continue
+                            _apply_webhook_event(event, conn, cur)
+                        # Audit row and handler effects land together; a
+                        # failure below rolls both back so the redelivery
+                        # is processed instead of skipped as a duplicate
+                        conn.commit()
+                    except Exception as e:
+                        logger.error(f"Error handling event {event.get('id')}: {e}")
+                        conn.rollback()
+        except Exception as e:
+            logger.error(f"Webhook worker flush failed ({len(batch)} events): {e}")
+        finally:
+            for _ in batch:
+                _webhook_queue.task_done()
+
+threading.Thread(target=_webhook_worker, name='webhook-worker', daemon=True).start()
+threading.Thread(target=_plan_invalidation_listener, name='plan-cache-listener', daemon=True).start()
+
 # Add a route to handle Stripe webhook events
 @app.route('/webhook', methods=['POST'])
 def stripe_webhook():
     """Handle Stripe webhook events"""
-    payload = request.get_data(as_text=True)
+    # Raw bytes: the SDK HMACs bytes anyway, so decoding to str here would
+    # just force a decode/encode round trip per delivery
+    payload = request.get_data(cache=False)
     sig_header = request.headers.get('Stripe-Signature')
     event = None
-    
+
     # Verify the webhook signature
     try:
         event = stripe.Webhook.construct_event(
@@ -1351,121 +1954,88 @@ def stripe_webhook():
         # Invalid signature
         logger.error(f"Invalid signature: {e}")
         return jsonify({'error': 'Invalid signature'}), 401
-    
-    # Handle the event
+
+    logger.info(f"Received event: {event['type']}")
+
+    # Hand the verified event to the background worker and ack right away;
+    # if the buffer is full (sustained replay storm) fall back to handling
+    # it inline rather than dropping it
     try:
-        logger.info(f"Received event: {event['type']}")
-        
-        # Handle different event types
-        if event['type'] == 'customer.created':
-            customer_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_customer(customer_data, conn, cur)
-        
-        elif event['type'] == 'customer.updated':
-            customer_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_customer(customer_data, conn, cur)
-        
-        elif event['type'] == 'customer.deleted':
-            customer_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    # Soft delete the customer in the database
-                    cur.execute("""
-                        UPDATE customers 
-                        SET deleted_at = %s 
-                        WHERE stripe_id = %s
-                    """, (datetime.now(), customer_data['id']))
-        
-        elif event['type'] == 'subscription.created':
-            subscription_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_subscription_new(subscription_data, conn, cur)
-        
-        elif event['type'] == 'subscription.updated':
-            subscription_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_subscription_new(subscription_data, conn, cur)
-        
-        elif event['type'] == 'subscription.deleted':
-            subscription_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    # Soft delete the subscription in the database
-                    cur.execute("""
-                        UPDATE subscriptions 
-                        SET canceled_at = %s, status = 'canceled' 
-                        WHERE stripe_id = %s
-                    """, (datetime.now(), subscription_data['id']))
-        
-        elif event['type'] == 'invoice.created':
-            invoice_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_invoice_new(invoice_data, conn, cur)
-        
-        elif event['type'] == 'invoice.updated':
-            invoice_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    upsert_invoice_new(invoice_data, conn, cur)
-        
-        elif event['type'] == 'invoice.payment_succeeded':
-            invoice_data = event['data']['object']
-            with get_db_connection() as conn:
-                with conn.cursor() as cur:
-                    # Update invoice status to paid
-                    cur.execute("""
-                        UPDATE invoices 
-                        SET status = 'paid', paid_at = %s 
-                        WHERE stripe_id = %s
-                    """, (datetime.now(), invoice_data['id']))
-        
-        elif event['type'] == 'invoice.payment_failed':
-            invoice_data = event['data']['object']
-            with get_db_connection() as conn:
+        _webhook_queue.put_nowait(event)
+    except queue.Full:
+        logger.warning(f"Webhook queue full, handling event {event['id']} inline")
+        try:
+            with db_conn() as conn:
                 with conn.cursor() as cur:
-                    # Update invoice status to unpaid
-                    cur.execute("""
-                        UPDATE invoices 
-                        SET status = 'unpaid' 
-                        WHERE stripe_id = %s
-                    """, (invoice_data['id'],))
-        
-        # Acknowledge the event
-        return jsonify({'status': 'success'}), 200
-    except Exception as e:
-        logger.error(f"Error handling event {event['type']}: {e}")
-        return jsonify({'error': 'Internal server error'}), 500
+                    if not store_stripe_event(event, conn, cur):
+                        logger.info(f"Skipping duplicate event {event['id']}")
+                        return jsonify({'status': 'duplicate'}), 200
+                    _apply_webhook_event(event, conn, cur)
+        except Exception as e:
+            logger.error(f"Error handling event {event['type']}: {e}")
+            return jsonify({'error': 'Internal server error'}), 500
 
-# Application startup
-if __name__ == '__main__':
-    # Ensure users table exists
-    conn = get_db_connection()
-    cur = conn.cursor()
+    # Acknowledge the event
+    return jsonify({'status': 'success'}), 200
+
+# All startup DDL in one multi-statement batch: one connection, one
+# transaction, one round trip
+_BOOTSTRAP_DDL = """
+    CREATE TABLE IF NOT EXISTS app_users (
+        id SERIAL PRIMARY KEY,
+        name VARCHAR(255) NOT NULL,
+        email VARCHAR(255) UNIQUE NOT NULL,
+        password_hash VARCHAR(256) NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    );
+    -- Migration for deployments created before addresses moved to JSONB
+    ALTER TABLE customers ADD COLUMN IF NOT EXISTS address JSONB;
+    -- Case-insensitive email lookups stay index-hits; the schema's plain
+    -- email and stripe_id indexes already cover the exact-match paths
+    CREATE UNIQUE INDEX IF NOT EXISTS ux_app_users_email_lower ON app_users(LOWER(email));
+    CREATE INDEX IF NOT EXISTS ix_customers_email_lower ON customers(LOWER(email));
+    -- Customer-scoped history reads filter on customer_id and sort by
+    -- recency; composite indexes let them stream in order, and the
+    -- INCLUDE columns keep the common projections index-only
+    CREATE INDEX IF NOT EXISTS idx_subscriptions_customer_created
+        ON subscriptions (customer_id, created_at_stripe DESC)
+        INCLUDE (stripe_id, status, current_period_start, current_period_end);
+    CREATE INDEX IF NOT EXISTS idx_invoices_customer_created
+        ON invoices (customer_id, created_at_stripe DESC)
+        INCLUDE (stripe_id, status, amount_due, amount_paid, currency);
+    CREATE INDEX IF NOT EXISTS idx_invoice_items_customer_created
+        ON invoice_items (customer_id, created_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_invoice_line_items_invoice_subscription
+        ON invoice_line_items (invoice_id, id) WHERE type = 'subscription';
+    -- The plan-history tooling filters stripe_events on the embedded
+    -- customer id; without this expression index every lookup is a
+    -- sequential scan casting JSON on each row
+    CREATE INDEX IF NOT EXISTS idx_stripe_events_customer
+        ON stripe_events ((raw_data->'data'->'object'->>'customer'), event_type, created_at DESC);
+    -- Covering index so the id -> stripe_id correlated subquery is an
+    -- index-only scan
+    CREATE INDEX IF NOT EXISTS idx_customers_id_stripe_id
+        ON customers (id) INCLUDE (stripe_id);
+    -- stripe_events must stay crash-safe: it backs the plan-change timeline
+    -- (the plan_plan_changes query) and webhook dedupe, and Stripe's
+    -- events.list only retains ~30 days, so it is NOT rebuildable. SET LOGGED
+    -- also repairs deployments where an earlier bootstrap made it unlogged.
+    ALTER TABLE stripe_events SET LOGGED;
+"""
+
+def _bootstrap_schema():
+    """Ensure startup tables and indexes exist (idempotent, never fatal)"""
     try:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS app_users (
-                id SERIAL PRIMARY KEY,
-                name VARCHAR(255) NOT NULL,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                password_hash VARCHAR(256) NOT NULL,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        conn.commit()
+        with db_cursor() as cur:
+            cur.execute(_BOOTSTRAP_DDL)
         logger.info("✅ App users table ready")
     except Exception as e:
         logger.warning(f"⚠️  Warning: Could not create app_users table: {e}")
-    finally:
-        cur.close()
-        conn.close()
-    
+
+# Application startup
+if __name__ == '__main__':
+    _bootstrap_schema()
+
     logger.info("🚀 Starting Flask application on port 4242")
-    app.run(debug=True, port=4242)
\ No newline at end of file
+    app.run(port=4242)
\ No newline at end of file
@@ -16,38 +16,395 @@ Usage:
 
 import os
 import sys
-import json
+import atexit
+import sqlite3
+import threading
+import time
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
 from typing import Dict, List, Optional, Any
+import orjson
 import psycopg2
 from psycopg2.extras import RealDictCursor
-import stripe
+from psycopg2.pool import ThreadedConnectionPool
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# Configure Stripe
-stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
-
 # Database configuration
 DATABASE_URL = os.getenv('PSQL_DB_URL')
 
+class PooledConnection(psycopg2.extensions.connection):
+    """Connection subclass so per-connection flags can be attached"""
+    plan_statements_prepared = False
+
+# The per-customer SELECTs are prepared once per pooled connection;
+# EXECUTE then skips the Postgres parse/plan step on every repeat call
+_PREPARED_STATEMENTS = """
+    PREPARE plan_customer_by_email (text) AS
+        SELECT id, stripe_id, email, name, created_at
+        FROM customers
+        WHERE email = $1;
+    PREPARE plan_customer_by_stripe_id (text) AS
+        SELECT id, stripe_id, email, name, created_at
+        FROM customers
+        WHERE stripe_id = $1;
+    PREPARE plan_subscriptions (int) AS
+        SELECT
+            s.id,
+            s.stripe_id,
+            s.status,
+            s.current_period_start,
+            s.current_period_end,
+            s.created_at_stripe,
+            s.started_at,
+            s.ended_at,
+            s.canceled_at,
+            s.cancel_at_period_end,
+            s.cancellation_reason,
+            s.collection_method,
+            s.trial_start,
+            s.trial_end,
+            s.metadata,
+            COALESCE(
+                jsonb_agg(
+                    jsonb_build_object(
+                        'id', si.id,
+                        'stripe_id', si.stripe_id,
+                        'quantity', si.quantity,
+                        'item_metadata', si.metadata,
+                        'price_stripe_id', p.stripe_id,
+                        'unit_amount', p.unit_amount,
+                        'currency', p.currency,
+                        'billing_scheme', p.billing_scheme,
+                        'recurring_interval', p.recurring_interval,
+                        'recurring_interval_count', p.recurring_interval_count,
+                        'lookup_key', p.lookup_key,
+                        'price_nickname', p.nickname,
+                        'price_metadata', p.metadata,
+                        'product_stripe_id', pr.stripe_id,
+                        'product_name', pr.name,
+                        'product_description', pr.description,
+                        'product_metadata', pr.metadata,
+                        'price_display', CASE
+                            WHEN p.unit_amount IS NULL THEN 'N/A'
+                            ELSE to_char(p.unit_amount / 100.0, 'FM999999990.00')
+                                 || ' ' || upper(p.currency)
+                        END,
+                        'billing_display', CASE
+                            WHEN p.recurring_interval IS NULL THEN 'One-time'
+                            WHEN p.recurring_interval_count = 1
+                                THEN 'Every ' || p.recurring_interval
+                            ELSE 'Every ' || p.recurring_interval_count
+                                 || ' ' || p.recurring_interval || 's'
+                        END
+                    ) ORDER BY si.id
+                ) FILTER (WHERE si.id IS NOT NULL),
+                '[]'
+            ) as plans
+        FROM subscriptions s
+        LEFT JOIN subscription_items si ON si.subscription_id = s.id
+        LEFT JOIN prices p ON si.price_id = p.id
+        LEFT JOIN products pr ON p.product_id = pr.id
+        WHERE s.customer_id = $1
+        GROUP BY s.id
+        ORDER BY s.created_at_stripe DESC;
+    PREPARE plan_invoices (int) AS
+        SELECT
+            i.id,
+            i.stripe_id,
+            i.status,
+            i.amount_due,
+            i.amount_paid,
+            i.currency,
+            i.period_start,
+            i.period_end,
+            i.created_at_stripe,
+            i.paid_at,
+            s.stripe_id as subscription_stripe_id,
+            s.status as subscription_status
+        FROM invoices i
+        LEFT JOIN subscriptions s ON i.subscription_id = s.id
+        WHERE i.customer_id = $1
+        ORDER BY i.created_at_stripe DESC;
+    PREPARE plan_invoice_lines (int[]) AS
+        SELECT
+            ili.id,
+            ili.invoice_id,
+            ili.stripe_id,
+            ili.amount,
+            ili.currency,
+            ili.description,
+            ili.period_start,
+            ili.period_end,
+            ili.quantity,
+            p.stripe_id as price_stripe_id,
+            p.unit_amount,
+            p.recurring_interval,
+            p.lookup_key,
+            p.nickname as price_nickname,
+            pr.stripe_id as product_stripe_id,
+            pr.name as product_name,
+            pr.description as product_description
+        FROM invoice_line_items ili
+        LEFT JOIN prices p ON ili.price_id = p.id
+        LEFT JOIN products pr ON p.product_id = pr.id
+        WHERE ili.invoice_id = ANY($1)
+        ORDER BY ili.invoice_id, ili.id;
+    PREPARE plan_invoice_items (int) AS
+        SELECT
+            ii.id,
+            ii.stripe_id,
+            ii.amount,
+            ii.currency,
+            ii.description,
+            ii.proration,
+            ii.period_start,
+            ii.period_end,
+            ii.created_at,
+            p.stripe_id as price_stripe_id,
+            p.unit_amount,
+            p.recurring_interval,
+            p.lookup_key,
+            p.nickname as price_nickname,
+            pr.stripe_id as product_stripe_id,
+            pr.name as product_name,
+            pr.description as product_description,
+            i.stripe_id as invoice_stripe_id,
+            s.stripe_id as subscription_stripe_id
+        FROM invoice_items ii
+        LEFT JOIN invoices i ON ii.invoice_id = i.id
+        LEFT JOIN subscriptions s ON ii.subscription_id = s.id
+        LEFT JOIN prices p ON ii.price_id = p.id
+        LEFT JOIN products pr ON p.product_id = pr.id
+        WHERE ii.customer_id = $1
+        ORDER BY ii.created_at DESC;
+    PREPARE plan_totals (int) AS
+        SELECT
+            COALESCE((SELECT SUM(amount_paid) FROM invoices WHERE customer_id = $1), 0)
+            + COALESCE((SELECT SUM(amount) FROM invoice_items WHERE customer_id = $1), 0)
+                as total_paid,
+            (SELECT currency FROM invoices WHERE customer_id = $1
+             ORDER BY created_at_stripe DESC LIMIT 1) as currency;
+    PREPARE plan_product_names (int) AS
+        SELECT DISTINCT pr.name
+        FROM subscription_items si
+        JOIN subscriptions s ON si.subscription_id = s.id
+        JOIN prices p ON si.price_id = p.id
+        JOIN products pr ON p.product_id = pr.id
+        WHERE s.customer_id = $1
+        AND pr.name IS NOT NULL;
+    PREPARE plan_change_events (text) AS
+        SELECT
+            se.stripe_event_id,
+            se.event_type,
+            se.created_at
+        FROM stripe_events se
+        WHERE se.event_type IN (
+            'customer.subscription.created',
+            'customer.subscription.updated',
+            'customer.subscription.deleted',
+            'customer.subscription.trial_will_end',
+            'invoice.payment_succeeded'
+        )
+        AND se.raw_data->'data'->'object'->>'customer' = $1
+        ORDER BY se.created_at DESC;
+    PREPARE plan_plan_changes (text) AS
+        SELECT DISTINCT ON (
+            t.event_type, t.subscription_id, t.price_amount,
+            t."interval", t.lookup_key
+        ) t.*
+        FROM (
+        SELECT
+            CASE se.event_type
+                WHEN 'customer.subscription.created' THEN 'plan_created'
+                WHEN 'customer.subscription.updated' THEN 'plan_updated'
+                ELSE 'plan_billed'
+            END as event_type,
+            se.created_at as timestamp,
+            CASE WHEN se.event_type = 'invoice.payment_succeeded'
+                 THEN item->>'subscription'
+                 ELSE se.raw_data#>>'{data,object,id}'
+            END as subscription_id,
+            CASE WHEN jsonb_typeof(item->'price'->'product') = 'object'
+                 THEN item->'price'->'product'->>'name'
+            END as product_name,
+            (item->'price'->>'unit_amount')::bigint as price_amount,
+            CASE WHEN se.event_type = 'invoice.payment_succeeded'
+                 THEN item->>'currency'
+                 ELSE item->'price'->>'currency'
+            END as currency,
+            item->'price'->'recurring'->>'interval' as interval,
+            item->'price'->>'lookup_key' as lookup_key,
+            CASE WHEN se.event_type = 'invoice.payment_succeeded'
+                 THEN (item->>'amount')::bigint
+            END as amount_paid,
+            CASE WHEN se.event_type = 'invoice.payment_succeeded'
+                 THEN to_timestamp((item#>>'{period,start}')::bigint)
+            END as period_start,
+            CASE WHEN se.event_type = 'invoice.payment_succeeded'
+                 THEN to_timestamp((item#>>'{period,end}')::bigint)
+            END as period_end,
+            se.stripe_event_id as event_id
+        FROM stripe_events se,
+        LATERAL jsonb_array_elements(
+            COALESCE(se.raw_data#>'{data,object,items,data}',
+                     se.raw_data#>'{data,object,lines,data}')
+        ) item
+        WHERE se.event_type IN (
+            'customer.subscription.created',
+            'customer.subscription.updated',
+            'invoice.payment_succeeded'
+        )
+        AND se.raw_data->'data'->'object'->>'customer' = $1
+        AND (se.event_type != 'invoice.payment_succeeded'
+             OR (item->>'type' = 'subscription'
+                 AND jsonb_typeof(item->'price') = 'object'))
+        ) t
+        ORDER BY
+            t.event_type, t.subscription_id, t.price_amount,
+            t."interval", t.lookup_key, t."timestamp" ASC;
+    PREPARE plan_historical_plans (int) AS
+        SELECT
+            ili.period_start,
+            ili.period_end,
+            MAX(ili.amount) as amount,
+            ili.currency,
+            MAX(ili.description) as description,
+            MAX(p.stripe_id) as price_stripe_id,
+            MAX(p.unit_amount) as unit_amount,
+            MAX(p.recurring_interval) as recurring_interval,
+            MAX(p.lookup_key) as lookup_key,
+            MAX(p.nickname) as price_nickname,
+            MAX(pr.stripe_id) as product_stripe_id,
+            MAX(pr.name) as product_name,
+            MAX(pr.description) as product_description,
+            MAX(i.created_at_stripe) as invoice_date,
+            MAX(i.status) as invoice_status,
+            s.stripe_id as subscription_stripe_id,
+            CASE
+                WHEN MAX(ili.amount) IS NULL THEN 'N/A'
+                ELSE to_char(MAX(ili.amount) / 100.0, 'FM999999990.00')
+                     || ' ' || upper(ili.currency)
+            END as amount_display
+        FROM invoice_line_items ili
+        JOIN invoices i ON ili.invoice_id = i.id
+        LEFT JOIN subscriptions s ON ili.subscription_id = s.id
+        LEFT JOIN prices p ON ili.price_id = p.id
+        LEFT JOIN products pr ON p.product_id = pr.id
+        WHERE i.customer_id = $1
+        AND ili.type = 'subscription'
+        GROUP BY s.stripe_id, ili.period_start, ili.period_end, ili.currency
+        ORDER BY ili.period_start DESC;
+"""
+
 class UserPlanHistoryFetcher:
-    def __init__(self):
-        self.conn = None
+    def __init__(self, disk_cache_ttl: int = 0):
+        """disk_cache_ttl > 0 enables the on-disk result cache (seconds)
+
+        Meant for the CLI, where the same customer is often inspected
+        several times in a support session; the web app keeps it
+        disabled because its in-process cache is invalidated by
+        webhooks, which the disk cache would bypass.
+        """
+        self.pool = None
+        self.disk_cache_ttl = disk_cache_ttl
+        self.disk_cache_path = os.path.expanduser(
+            os.getenv('PLAN_HISTORY_CACHE_FILE', '~/.stripe_plan_history_cache.db'))
         self.setup_database_connection()
-    
+
+    def _disk_cache_conn(self):
+        """Open the SQLite result cache, creating it on first use"""
+        cache = sqlite3.connect(self.disk_cache_path)
+        cache.execute("PRAGMA journal_mode=WAL")
+        cache.execute("""
+            CREATE TABLE IF NOT EXISTS plan_history_cache (
+                customer_key TEXT PRIMARY KEY,
+                computed_at REAL NOT NULL,
+                blob BLOB NOT NULL
+            )
+        """)
+        return cache
+
+    def _disk_cache_get(self, customer_key: str) -> Optional[Dict]:
+        """Return a cached result younger than the TTL, or None"""
+        try:
+            with self._disk_cache_conn() as cache:
+                row = cache.execute(
+                    "SELECT blob FROM plan_history_cache"
+                    " WHERE customer_key = ? AND computed_at > ?",
+                    (customer_key, time.time() - self.disk_cache_ttl)
+                ).fetchone()
+            return orjson.loads(row[0]) if row else None
+        except Exception as e:
+            print(f"⚠️  Warning: Could not read result cache: {e}")
+            return None
+
+    def _disk_cache_put(self, customer_key: str, results: Dict):
+        """Store a freshly computed result in the cache"""
+        try:
+            with self._disk_cache_conn() as cache:
+                cache.execute(
+                    "INSERT OR REPLACE INTO plan_history_cache"
+                    " (customer_key, computed_at, blob) VALUES (?, ?, ?)",
+                    (customer_key, time.time(), orjson.dumps(results, default=str))
+                )
+        except Exception as e:
+            print(f"⚠️  Warning: Could not write result cache: {e}")
+
     def setup_database_connection(self):
-        """Setup database connection"""
+        """Setup database connection pool"""
         try:
-            self.conn = psycopg2.connect(DATABASE_URL)
-            print("✅ Database connection established")
+            # A small pool instead of a single connection so the read
+            # queries can run concurrently and repeated fetches reuse
+            # warm connections instead of paying a new handshake each time.
+            maxconn = 16
+            self.pool = ThreadedConnectionPool(
+                2, maxconn, DATABASE_URL,
+                connection_factory=PooledConnection,
+                keepalives=1, keepalives_idle=30
+            )
+            # getconn raises the moment the pool is empty; with several
+            # concurrent fan-outs (8 queries each) that exhausts 16
+            # connections fast, so checkout waits on a slot instead
+            self.pool_slots = threading.BoundedSemaphore(maxconn)
+            atexit.register(self.close)
+            print("✅ Database connection pool established")
         except Exception as e:
             print(f"❌ Database connection failed: {e}")
             sys.exit(1)
-    
+
+    @contextmanager
+    def cursor(self):
+        """Borrow a pooled connection and yield a dict cursor on it
+
+        Blocks while the pool is fully checked out rather than raising,
+        so overlapping fan-outs queue up instead of failing.
+        """
+        self.pool_slots.acquire()
+        try:
+            conn = self.pool.getconn()
+        except Exception:
+            self.pool_slots.release()
+            raise
+        try:
+            if not conn.plan_statements_prepared:
+                with conn.cursor() as cur:
+                    cur.execute(_PREPARED_STATEMENTS)
+                conn.commit()
+                conn.plan_statements_prepared = True
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                yield cur
+            conn.commit()
+        finally:
+            try:
+                self.pool.putconn(conn)
+            finally:
+                self.pool_slots.release()
+
     def safe_datetime_convert(self, timestamp):
         """Safely convert timestamp to datetime object"""
         if timestamp is None:
@@ -80,185 +437,81 @@ class UserPlanHistoryFetcher:
     
     def get_customer_by_email(self, email: str) -> Optional[Dict]:
         """Get customer information by email"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT id, stripe_id, email, name, created_at
-                FROM customers 
-                WHERE email = %s
-            """, (email,))
-            result = cursor.fetchone()
-            return dict(result) if result else None
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_customer_by_email(%s)", (email,))
+            return cursor.fetchone()
     
     def get_customer_by_stripe_id(self, stripe_customer_id: str) -> Optional[Dict]:
         """Get customer information by Stripe ID"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT id, stripe_id, email, name, created_at
-                FROM customers 
-                WHERE stripe_id = %s
-            """, (stripe_customer_id,))
-            result = cursor.fetchone()
-            return dict(result) if result else None
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_customer_by_stripe_id(%s)", (stripe_customer_id,))
+            return cursor.fetchone()
     
     def get_all_subscriptions_for_customer(self, customer_db_id: int) -> List[Dict]:
-        """Get all subscriptions (current and historical) for a customer"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    s.id,
-                    s.stripe_id,
-                    s.status,
-                    s.current_period_start,
-                    s.current_period_end,
-                    s.created_at_stripe,
-                    s.started_at,
-                    s.ended_at,
-                    s.canceled_at,
-                    s.cancel_at_period_end,
-                    s.cancellation_reason,
-                    s.collection_method,
-                    s.trial_start,
-                    s.trial_end,
-                    s.metadata
-                FROM subscriptions s
-                WHERE s.customer_id = %s
-                ORDER BY s.created_at_stripe DESC
-            """, (customer_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
-    
-    def get_subscription_items_for_subscription(self, subscription_db_id: int) -> List[Dict]:
-        """Get all subscription items (plans) for a specific subscription"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    si.id,
-                    si.stripe_id,
-                    si.quantity,
-                    si.metadata as item_metadata,
-                    p.stripe_id as price_stripe_id,
-                    p.unit_amount,
-                    p.currency,
-                    p.billing_scheme,
-                    p.recurring_interval,
-                    p.recurring_interval_count,
-                    p.lookup_key,
-                    p.nickname as price_nickname,
-                    p.metadata as price_metadata,
-                    pr.stripe_id as product_stripe_id,
-                    pr.name as product_name,
-                    pr.description as product_description,
-                    pr.metadata as product_metadata
-                FROM subscription_items si
-                LEFT JOIN prices p ON si.price_id = p.id
-                LEFT JOIN products pr ON p.product_id = pr.id
-                WHERE si.subscription_id = %s
-                ORDER BY si.id
-            """, (subscription_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
-    
+        """Get all subscriptions for a customer with their plans embedded
+
+        Each row carries a ``plans`` array built with jsonb_agg, so one
+        round-trip returns subscriptions, items, prices and products
+        already stitched together.
+        """
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_subscriptions(%s)", (customer_db_id,))
+            return cursor.fetchall()
+
     def get_invoice_history_for_customer(self, customer_db_id: int) -> List[Dict]:
         """Get invoice history with plan information"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    i.id,
-                    i.stripe_id,
-                    i.status,
-                    i.amount_due,
-                    i.amount_paid,
-                    i.currency,
-                    i.period_start,
-                    i.period_end,
-                    i.created_at_stripe,
-                    i.paid_at,
-                    s.stripe_id as subscription_stripe_id,
-                    s.status as subscription_status
-                FROM invoices i
-                LEFT JOIN subscriptions s ON i.subscription_id = s.id
-                WHERE i.customer_id = %s
-                ORDER BY i.created_at_stripe DESC
-            """, (customer_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_invoices(%s)", (customer_db_id,))
+            return cursor.fetchall()
     
-    def get_invoice_line_items_for_invoice(self, invoice_db_id: int) -> List[Dict]:
-        """Get line items for a specific invoice"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    ili.id,
-                    ili.stripe_id,
-                    ili.amount,
-                    ili.currency,
-                    ili.description,
-                    ili.period_start,
-                    ili.period_end,
-                    ili.quantity,
-                    p.stripe_id as price_stripe_id,
-                    p.unit_amount,
-                    p.recurring_interval,
-                    p.lookup_key,
-                    p.nickname as price_nickname,
-                    pr.stripe_id as product_stripe_id,
-                    pr.name as product_name,
-                    pr.description as product_description
-                FROM invoice_line_items ili
-                LEFT JOIN prices p ON ili.price_id = p.id
-                LEFT JOIN products pr ON p.product_id = pr.id
-                WHERE ili.invoice_id = %s
-                ORDER BY ili.id
-            """, (invoice_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
+    def get_invoice_line_items_bulk(self, invoice_db_ids: List[int]) -> Dict[int, List[Dict]]:
+        """Get line items for many invoices in one query"""
+        lines_by_invoice = {invoice_id: [] for invoice_id in invoice_db_ids}
+        if not invoice_db_ids:
+            return lines_by_invoice
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_invoice_lines(%s)", (invoice_db_ids,))
+            for row in cursor.fetchall():
+                lines_by_invoice[row['invoice_id']].append(row)
+        return lines_by_invoice
     
     def get_invoice_items_for_customer(self, customer_db_id: int) -> List[Dict]:
         """Get all invoice items (including prorations) for a customer"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    ii.id,
-                    ii.stripe_id,
-                    ii.amount,
-                    ii.currency,
-                    ii.description,
-                    ii.proration,
-                    ii.period_start,
-                    ii.period_end,
-                    ii.created_at,
-                    p.stripe_id as price_stripe_id,
-                    p.unit_amount,
-                    p.recurring_interval,
-                    p.lookup_key,
-                    p.nickname as price_nickname,
-                    pr.stripe_id as product_stripe_id,
-                    pr.name as product_name,
-                    pr.description as product_description,
-                    i.stripe_id as invoice_stripe_id,
-                    s.stripe_id as subscription_stripe_id
-                FROM invoice_items ii
-                LEFT JOIN invoices i ON ii.invoice_id = i.id
-                LEFT JOIN subscriptions s ON ii.subscription_id = s.id
-                LEFT JOIN prices p ON ii.price_id = p.id
-                LEFT JOIN products pr ON p.product_id = pr.id
-                WHERE ii.customer_id = %s
-                ORDER BY ii.created_at DESC
-            """, (customer_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_invoice_items(%s)", (customer_db_id,))
+            return cursor.fetchall()
     
     def enrich_with_stripe_data(self, customer_stripe_id: str) -> Dict:
         """Fetch additional data from Stripe API if needed"""
-        try:
-            # Get customer from Stripe
-            stripe_customer = stripe.Customer.retrieve(customer_stripe_id)
-            
-            # Get subscription history from Stripe (includes deleted subscriptions)
-            stripe_subscriptions = stripe.Subscription.list(
+        # The Stripe SDK is the heaviest import in the module and this is
+        # its only consumer; loading it lazily keeps --help and DB-only
+        # paths fast
+        import stripe
+        stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
+
+        def fetch_subscriptions():
+            # auto_paging_iter follows has_more/starting_after cursors, so
+            # customers with more than one page of subscriptions are no
+            # longer silently truncated at 100
+            return list(stripe.Subscription.list(
                 customer=customer_stripe_id,
                 limit=100,
                 status='all'
-            )
-            
+            ).auto_paging_iter())
+
+        try:
+            # The customer retrieve and the subscription listing are
+            # independent calls; overlap them instead of paying both
+            # round-trips back to back
+            with ThreadPoolExecutor(max_workers=2) as executor:
+                customer_future = executor.submit(stripe.Customer.retrieve, customer_stripe_id)
+                subscriptions_future = executor.submit(fetch_subscriptions)
+                stripe_customer = customer_future.result()
+                stripe_subscriptions = subscriptions_future.result()
+
             return {
                 'stripe_customer': stripe_customer,
-                'stripe_subscriptions': stripe_subscriptions.data
+                'stripe_subscriptions': stripe_subscriptions
             }
         except Exception as e:
             print(f"⚠️  Warning: Could not fetch additional Stripe data: {e}")
@@ -283,7 +536,14 @@ class UserPlanHistoryFetcher:
     def get_comprehensive_plan_history(self, customer_identifier: str, is_email: bool = False) -> Dict:
         """Get comprehensive plan history for a customer"""
         print(f"🔍 Fetching plan history for {'email' if is_email else 'Stripe customer ID'}: {customer_identifier}")
-        
+
+        if self.disk_cache_ttl:
+            cached = self._disk_cache_get(customer_identifier)
+            if cached is not None:
+                print("⚡ Served from local result cache")
+                return cached
+
+
         # Get customer info
         if is_email:
             customer = self.get_customer_by_email(customer_identifier)
@@ -298,46 +558,51 @@ class UserPlanHistoryFetcher:
         customer_stripe_id = customer['stripe_id']
         
         print(f"📋 Found customer: {customer['name']} ({customer['email']})")
-        
-        # Get all subscriptions
-        subscriptions = self.get_all_subscriptions_for_customer(customer_db_id)
+
+        # The remaining reads are independent (all keyed on the customer),
+        # so fan them out over the connection pool instead of paying one
+        # round-trip after another. The Stripe API call overlaps with the
+        # database work for free.
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            subscriptions_future = executor.submit(self.get_all_subscriptions_for_customer, customer_db_id)
+            invoices_future = executor.submit(self.get_invoice_history_for_customer, customer_db_id)
+            invoice_items_future = executor.submit(self.get_invoice_items_for_customer, customer_db_id)
+            events_future = executor.submit(self.get_subscription_change_events, customer_stripe_id)
+            plan_changes_future = executor.submit(self.get_plan_changes_for_customer, customer_stripe_id)
+            historical_future = executor.submit(self.get_historical_plans_from_invoices, customer_db_id)
+            stripe_future = executor.submit(self.enrich_with_stripe_data, customer_stripe_id)
+            aggregates_future = executor.submit(self.get_summary_aggregates, customer_db_id)
+
+            subscriptions = subscriptions_future.result()
+            invoices = invoices_future.result()
+            invoice_items = invoice_items_future.result()
+            events = events_future.result()
+            plan_changes = plan_changes_future.result()
+            historical_plans = historical_future.result()
+            stripe_data = stripe_future.result()
+            aggregates = aggregates_future.result()
+
         print(f"📊 Found {len(subscriptions)} subscription(s)")
-        
-        # Get subscription details with plans
-        detailed_subscriptions = []
-        for sub in subscriptions:
-            subscription_items = self.get_subscription_items_for_subscription(sub['id'])
-            sub['plans'] = subscription_items
-            detailed_subscriptions.append(sub)
-        
-        # Get invoice history
-        invoices = self.get_invoice_history_for_customer(customer_db_id)
+
+        # Plans arrive embedded on each subscription row via jsonb_agg
+        detailed_subscriptions = subscriptions
+
         print(f"🧾 Found {len(invoices)} invoice(s)")
-        
-        # Get invoice line items
+
+        # Attach line items to invoices — one query for all of them
+        lines_by_invoice = self.get_invoice_line_items_bulk([invoice['id'] for invoice in invoices])
         detailed_invoices = []
         for invoice in invoices:
-            line_items = self.get_invoice_line_items_for_invoice(invoice['id'])
-            invoice['line_items'] = line_items
+            invoice['line_items'] = lines_by_invoice[invoice['id']]
             detailed_invoices.append(invoice)
-        
-        # Get additional Stripe data
-        stripe_data = self.enrich_with_stripe_data(customer_stripe_id)
-        
-        # Get subscription change events
-        events = self.get_subscription_change_events(customer_db_id)
-        plan_changes = self.get_plan_changes_from_events(events)
+
         print(f"📅 Found {len(plan_changes)} plan change event(s)")
-        
-        # Get historical plans from invoices
-        historical_plans = self.get_historical_plans_from_invoices(customer_db_id)
+
         print(f"📋 Found {len(historical_plans)} historical plan period(s)")
-        
-        # Get invoice items (prorations)
-        invoice_items = self.get_invoice_items_for_customer(customer_db_id)
+
         print(f"💰 Found {len(invoice_items)} invoice item(s) (including prorations)")
-        
-        return {
+
+        results = {
             "customer": customer,
             "subscriptions": detailed_subscriptions,
             "invoices": detailed_invoices,
@@ -346,149 +611,52 @@ class UserPlanHistoryFetcher:
             "plan_changes": plan_changes,
             "historical_plans": historical_plans,
             "subscription_events": events,
-            "summary": self.generate_summary(customer, detailed_subscriptions, detailed_invoices, plan_changes, historical_plans, invoice_items)
+            "summary": self.generate_summary(customer, detailed_subscriptions, detailed_invoices, plan_changes, historical_plans, invoice_items, aggregates)
         }
+
+        if self.disk_cache_ttl:
+            self._disk_cache_put(customer_identifier, results)
+
+        return results
     
-    def get_subscription_change_events(self, customer_db_id: int) -> List[Dict]:
-        """Get subscription-related events that show plan changes"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT 
-                    se.stripe_event_id,
-                    se.event_type,
-                    se.created_at,
-                    se.raw_data
-                FROM stripe_events se
-                WHERE se.event_type IN (
-                    'customer.subscription.created',
-                    'customer.subscription.updated', 
-                    'customer.subscription.deleted',
-                    'customer.subscription.trial_will_end',
-                    'invoice.payment_succeeded'
-                )
-                AND se.raw_data::jsonb->'data'->'object'->>'customer' = (
-                    SELECT stripe_id FROM customers WHERE id = %s
-                )
-                ORDER BY se.created_at DESC
-            """, (customer_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
-    
-    def get_plan_changes_from_events(self, events: List[Dict]) -> List[Dict]:
-        """Extract plan changes from Stripe events"""
-        plan_changes = []
-        
-        for event in events:
-            try:
-                event_data = event['raw_data']
-                event_type = event['event_type']
-                created_at = event['created_at']
-                
-                if event_type == 'customer.subscription.updated':
-                    # Look for plan changes in subscription updates
-                    subscription_data = event_data.get('data', {}).get('object', {})
-                    items = subscription_data.get('items', {}).get('data', [])
-                    
-                    for item in items:
-                        price = item.get('price', {})
-                        product = price.get('product', {})
-                        
-                        plan_changes.append({
-                            'event_type': 'plan_updated',
-                            'timestamp': created_at,
-                            'subscription_id': subscription_data.get('id'),
-                            'product_name': product.get('name') if isinstance(product, dict) else None,
-                            'price_amount': price.get('unit_amount'),
-                            'currency': price.get('currency'),
-                            'interval': price.get('recurring', {}).get('interval'),
-                            'lookup_key': price.get('lookup_key'),
-                            'event_id': event['stripe_event_id']
-                        })
-                
-                elif event_type == 'customer.subscription.created':
-                    # Initial subscription creation
-                    subscription_data = event_data.get('data', {}).get('object', {})
-                    items = subscription_data.get('items', {}).get('data', [])
-                    
-                    for item in items:
-                        price = item.get('price', {})
-                        product = price.get('product', {})
-                        
-                        plan_changes.append({
-                            'event_type': 'plan_created',
-                            'timestamp': created_at,
-                            'subscription_id': subscription_data.get('id'),
-                            'product_name': product.get('name') if isinstance(product, dict) else None,
-                            'price_amount': price.get('unit_amount'),
-                            'currency': price.get('currency'),
-                            'interval': price.get('recurring', {}).get('interval'),
-                            'lookup_key': price.get('lookup_key'),
-                            'event_id': event['stripe_event_id']
-                        })
-                
-                elif event_type == 'invoice.payment_succeeded':
-                    # Look at invoice line items for historical plan info
-                    invoice_data = event_data.get('data', {}).get('object', {})
-                    lines = invoice_data.get('lines', {}).get('data', [])
-                    
-                    for line in lines:
-                        price = line.get('price', {})
-                        product = price.get('product', {}) if price else {}
-                        
-                        if price and line.get('type') == 'subscription':
-                            plan_changes.append({
-                                'event_type': 'plan_billed',
-                                'timestamp': created_at,
-                                'subscription_id': line.get('subscription'),
-                                'product_name': product.get('name') if isinstance(product, dict) else None,
-                                'price_amount': price.get('unit_amount'),
-                                'currency': line.get('currency'),
-                                'interval': price.get('recurring', {}).get('interval'),
-                                'lookup_key': price.get('lookup_key'),
-                                'amount_paid': line.get('amount'),
-                                'period_start': datetime.fromtimestamp(line.get('period', {}).get('start', 0)) if line.get('period', {}).get('start') else None,
-                                'period_end': datetime.fromtimestamp(line.get('period', {}).get('end', 0)) if line.get('period', {}).get('end') else None,
-                                'event_id': event['stripe_event_id']
-                            })
-                            
-            except Exception as e:
-                print(f"⚠️  Warning: Could not parse event {event.get('stripe_event_id', 'unknown')}: {e}")
-                continue
-        
-        return plan_changes
+    def get_subscription_change_events(self, customer_stripe_id: str) -> List[Dict]:
+        """Get subscription-related event metadata (id, type, timestamp)"""
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_change_events(%s)", (customer_stripe_id,))
+            return cursor.fetchall()
+
+    def get_summary_aggregates(self, customer_db_id: int) -> Dict:
+        """Get the summary totals and distinct plan names via SQL aggregates"""
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_totals(%s)", (customer_db_id,))
+            totals = cursor.fetchone()
+            cursor.execute("EXECUTE plan_product_names(%s)", (customer_db_id,))
+            product_names = [row['name'] for row in cursor.fetchall()]
+        return {
+            'total_paid': totals['total_paid'],
+            'currency': totals['currency'] or 'usd',
+            'product_names': product_names
+        }
+
+    def get_plan_changes_for_customer(self, customer_stripe_id: str) -> List[Dict]:
+        """Extract plan changes from Stripe events, projected server-side
+
+        A LATERAL jsonb_array_elements over the event payloads flattens
+        subscription items / invoice lines into plan-change rows inside
+        PostgreSQL, so only the few fields we display cross the wire
+        instead of every event's full raw_data blob.
+        """
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_plan_changes(%s)", (customer_stripe_id,))
+            return cursor.fetchall()
     
     def get_historical_plans_from_invoices(self, customer_db_id: int) -> List[Dict]:
         """Get historical plan information from invoice line items"""
-        with self.conn.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("""
-                SELECT DISTINCT
-                    ili.period_start,
-                    ili.period_end,
-                    ili.amount,
-                    ili.currency,
-                    ili.description,
-                    p.stripe_id as price_stripe_id,
-                    p.unit_amount,
-                    p.recurring_interval,
-                    p.lookup_key,
-                    p.nickname as price_nickname,
-                    pr.stripe_id as product_stripe_id,
-                    pr.name as product_name,
-                    pr.description as product_description,
-                    i.created_at_stripe as invoice_date,
-                    i.status as invoice_status,
-                    s.stripe_id as subscription_stripe_id
-                FROM invoice_line_items ili
-                JOIN invoices i ON ili.invoice_id = i.id
-                LEFT JOIN subscriptions s ON ili.subscription_id = s.id
-                LEFT JOIN prices p ON ili.price_id = p.id
-                LEFT JOIN products pr ON p.product_id = pr.id
-                WHERE i.customer_id = %s
-                AND ili.type = 'subscription'
-                ORDER BY ili.period_start DESC
-            """, (customer_db_id,))
-            return [dict(row) for row in cursor.fetchall()]
+        with self.cursor() as cursor:
+            cursor.execute("EXECUTE plan_historical_plans(%s)", (customer_db_id,))
+            return cursor.fetchall()
     
-    def generate_summary(self, customer: Dict, subscriptions: List[Dict], invoices: List[Dict], plan_changes: List[Dict] = None, historical_plans: List[Dict] = None, invoice_items: List[Dict] = None) -> Dict:
+    def generate_summary(self, customer: Dict, subscriptions: List[Dict], invoices: List[Dict], plan_changes: List[Dict] = None, historical_plans: List[Dict] = None, invoice_items: List[Dict] = None, aggregates: Dict = None) -> Dict:
         """Generate a summary of the customer's plan history"""
         active_subscriptions = [s for s in subscriptions if s['status'] in ['active', 'trialing']]
         
@@ -498,22 +666,16 @@ class UserPlanHistoryFetcher:
             for plan in sub.get('plans', []):
                 current_plans.append({
                     'product_name': plan['product_name'],
-                    'price': self.format_currency(plan['unit_amount'], plan['currency']),
-                    'billing_frequency': self.format_billing_frequency(
-                        plan['recurring_interval'], 
-                        plan['recurring_interval_count']
-                    ),
+                    'price': plan['price_display'],
+                    'billing_frequency': plan['billing_display'],
                     'subscription_status': sub['status'],
                     'current_period_end': self.safe_datetime_convert(sub['current_period_end'])
                 })
         
-        # Historical plans (from all subscriptions)
-        all_plans = set()
-        for sub in subscriptions:
-            for plan in sub.get('plans', []):
-                if plan['product_name']:
-                    all_plans.add(plan['product_name'])
-        
+        # Every plan name in the database comes back as one aggregated
+        # row set; only the event-derived names still need a Python union
+        all_plans = set(aggregates['product_names']) if aggregates else set()
+
         # Add plans from plan changes history
         if plan_changes:
             for change in plan_changes:
@@ -539,14 +701,16 @@ class UserPlanHistoryFetcher:
                     'billing_frequency': f"Every {change.get('interval', 'unknown')}" if change.get('interval') else 'N/A'
                 })
         
-        # Total spent (including invoice items)
-        total_paid = sum(invoice['amount_paid'] or 0 for invoice in invoices)
-        if invoice_items:
-            # Add positive invoice items (charges), subtract negative ones (credits are already negative)
-            total_from_items = sum(item['amount'] or 0 for item in invoice_items)
-            total_paid += total_from_items
-        
-        currency = invoices[0]['currency'] if invoices else 'usd'
+        # Total spent comes pre-summed from the database (invoices plus
+        # invoice items; credits are already negative)
+        if aggregates:
+            total_paid = aggregates['total_paid']
+            currency = aggregates['currency']
+        else:
+            total_paid = sum(invoice['amount_paid'] or 0 for invoice in invoices)
+            if invoice_items:
+                total_paid += sum(item['amount'] or 0 for item in invoice_items)
+            currency = invoices[0]['currency'] if invoices else 'usd'
         
         # Proration details
         prorations = []
@@ -649,7 +813,7 @@ class UserPlanHistoryFetcher:
             for i, plan in enumerate(results['historical_plans'], 1):
                 print(f"   {i}. {plan['product_name'] or 'Unknown Plan'}")
                 print(f"      Period: {plan['period_start']} to {plan['period_end']}")
-                print(f"      Amount: {self.format_currency(plan['amount'], plan['currency'])}")
+                print(f"      Amount: {plan['amount_display']}")
                 print(f"      Invoice Date: {plan['invoice_date']}")
                 print()
         
@@ -668,8 +832,8 @@ class UserPlanHistoryFetcher:
             print(f"   └─ Plans:")
             for j, plan in enumerate(sub.get('plans', []), 1):
                 print(f"      {j}. {plan['product_name'] or 'Unknown Product'}")
-                print(f"         Price: {self.format_currency(plan['unit_amount'], plan['currency'])}")
-                print(f"         Billing: {self.format_billing_frequency(plan['recurring_interval'], plan['recurring_interval_count'])}")
+                print(f"         Price: {plan['price_display']}")
+                print(f"         Billing: {plan['billing_display']}")
                 if plan['quantity'] and plan['quantity'] > 1:
                     print(f"         Quantity: {plan['quantity']}")
         
@@ -677,20 +841,16 @@ class UserPlanHistoryFetcher:
     
     def save_to_json(self, results: Dict, filename: str):
         """Save results to JSON file"""
-        # Convert datetime objects to strings for JSON serialization
-        def json_serializer(obj):
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
-        
-        with open(filename, 'w') as f:
-            json.dump(results, f, indent=2, default=json_serializer)
+        # orjson encodes datetimes natively in C, so no per-object
+        # default hook runs for them; default=str covers the stragglers
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NAIVE_UTC, default=str))
         print(f"📁 Results saved to {filename}")
     
     def close(self):
-        """Close database connection"""
-        if self.conn:
-            self.conn.close()
+        """Close all pooled database connections"""
+        if self.pool and not self.pool.closed:
+            self.pool.closeall()
 
 def main():
     parser = argparse.ArgumentParser(description='Fetch comprehensive plan history for a Stripe customer')
@@ -709,7 +869,8 @@ def main():
         print("  python get_user_plan_history.py cus_1234567890 --output plan_history.json")
         return
     
-    fetcher = UserPlanHistoryFetcher()
+    fetcher = UserPlanHistoryFetcher(
+        disk_cache_ttl=int(os.getenv('PLAN_HISTORY_DISK_CACHE_TTL', '300')))
     
     try:
         results = fetcher.get_comprehensive_plan_history(
@@ -718,13 +879,7 @@ def main():
         )
         
         if args.json_only:
-            # Convert datetime objects for JSON output
-            def json_serializer(obj):
-                if isinstance(obj, datetime):
-                    return obj.isoformat()
-                raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
-            
-            print(json.dumps(results, indent=2, default=json_serializer))
+            print(orjson.dumps(results, option=orjson.OPT_INDENT_2 | orjson.OPT_NAIVE_UTC, default=str).decode())
         else:
             fetcher.print_formatted_results(results)
         
@@ -14,6 +14,7 @@ Commands:
     clear-table <name>  - Clear data from specific table
     show-stats          - Show database statistics
     sync-stripe         - Sync data from Stripe
+    sync-subscription-items - Backfill missing subscription items from Stripe
     reset-database      - Reset database to initial state
     create-admin        - Create admin user
     backup-data         - Backup database data
@@ -24,26 +25,54 @@ Commands:
     help                - Show this help message
 """
 
+import io
 import os
 import sys
-import json
 import argparse
+import atexit
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import orjson
 from dotenv import load_dotenv
 import psycopg2
 from psycopg2.extras import RealDictCursor
+from psycopg2.pool import ThreadedConnectionPool
 import stripe
 
 # Load environment variables
 load_dotenv()
 
+# Hot loops log through here so per-row messages cost nothing at INFO+
+logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO'),
+                    format='%(levelname)s %(message)s')
+logger = logging.getLogger('manage')
+
 # Database configuration
 DATABASE_URL = os.getenv('PSQL_DB_URL')
 stripe.api_key = os.getenv('STRIPE_SECRET_KEY')
 
+_pool = None
+
+def _get_pool():
+    """Get (or create) the shared connection pool"""
+    global _pool
+    if _pool is None:
+        _pool = ThreadedConnectionPool(1, 8, DATABASE_URL,
+                                       cursor_factory=RealDictCursor)
+        atexit.register(_pool.closeall)
+    return _pool
+
 def get_db_connection():
-    """Get database connection"""
-    return psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
+    """Get a pooled database connection"""
+    return _get_pool().getconn()
+
+def release_db_connection(conn):
+    """Return a connection to the pool"""
+    _get_pool().putconn(conn)
 
 def list_tables():
     """List all database tables"""
@@ -70,7 +99,7 @@ def list_tables():
         print(f"❌ Error listing tables: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def show_table_stats():
     """Show statistics for all tables"""
@@ -119,7 +148,7 @@ def show_table_stats():
         print(f"❌ Error getting statistics: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def clear_all_tables():
     """Clear all data from all tables"""
@@ -192,7 +221,7 @@ def clear_all_tables():
         print(f"❌ Error clearing tables: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def clear_specific_table(table_name):
     """Clear data from specific table"""
@@ -230,7 +259,7 @@ def clear_specific_table(table_name):
         print(f"❌ Error clearing table {table_name}: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def sync_stripe_data():
     """Sync data from Stripe"""
@@ -300,7 +329,235 @@ def sync_stripe_data():
         print(f"❌ Error syncing Stripe data: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
+
+def _copy_escape(value):
+    """Escape a text field for COPY ... FROM STDIN WITH (FORMAT text)"""
+    return (value.replace('\\', '\\\\')
+                 .replace('\t', '\\t')
+                 .replace('\n', '\\n')
+                 .replace('\r', '\\r'))
+
+def sync_subscription_items():
+    """Backfill subscription_items for synced subscriptions that have none
+
+    Matching is driven by paginated stripe.Subscription.list calls with
+    items and prices expanded inline, so a backfill of N subscriptions
+    costs ceil(N/100) HTTP round-trips instead of one retrieve each.
+    """
+    print("🔄 Backfilling subscription items from Stripe...")
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        # Skip the WAL fsync on the checkpoint commits: a crash just means
+        # re-running the script, which the pre-diff makes idempotent, so
+        # per-commit durability buys nothing here
+        cur.execute("SET synchronous_commit = off")
+
+        # Subscriptions we know about that have no items yet; NOT EXISTS
+        # anti-joins short-circuit on the first matching item, and the
+        # schema's idx_subscription_items_subscription index keeps the
+        # probe side cheap
+        # Server-side cursor: rows stream over in itersize batches instead
+        # of one fetchall, keeping client memory flat on huge backfills
+        it_cur = conn.cursor(name='missing_subs')
+        it_cur.itersize = 1000
+        it_cur.execute("""
+            SELECT s.id, s.stripe_id
+            FROM subscriptions s
+            WHERE NOT EXISTS (
+                SELECT 1 FROM subscription_items si
+                WHERE si.subscription_id = s.id
+            )
+        """)
+        missing = {row['stripe_id']: row['id'] for row in it_cur}
+        it_cur.close()
+
+        if not missing:
+            print("✅ No subscriptions are missing items.")
+            return
+
+        print(f"📥 {len(missing)} subscriptions missing items; fetching from Stripe...")
+
+        # Prices don't change during a backfill; one query replaces a
+        # lookup per item
+        cur.execute("SELECT id, stripe_id FROM prices")
+        price_map = {row['stripe_id']: row['id'] for row in cur.fetchall()}
+
+        # Re-runs are the common case; skip items that already exist so an
+        # idempotent second pass stages (and WAL-writes) nothing
+        cur.execute("SELECT stripe_id FROM subscription_items")
+        existing = {row['stripe_id'] for row in cur.fetchall()}
+
+        skipped = 0
+        inserted = 0
+        processed = 0
+        rows = []
+
+        def flush_rows():
+            # COPY the pending batch into a staging table, upsert from it,
+            # and commit so a crash only loses the current batch
+            nonlocal inserted
+            if not rows:
+                return
+            cur.execute("""
+                CREATE TEMP TABLE si_stage (
+                    LIKE subscription_items INCLUDING DEFAULTS
+                ) ON COMMIT DROP
+            """)
+            buf = io.StringIO()
+            for stripe_id, sub_db_id, price_db_id, quantity, metadata in rows:
+                buf.write('\t'.join((
+                    _copy_escape(stripe_id),
+                    str(sub_db_id),
+                    str(price_db_id),
+                    str(quantity),
+                    _copy_escape(metadata),
+                )) + '\n')
+            buf.seek(0)
+            cur.copy_expert("""
+                COPY si_stage (stripe_id, subscription_id, price_id, quantity, metadata)
+                FROM STDIN WITH (FORMAT text)
+            """, buf)
+            cur.execute("""
+                INSERT INTO subscription_items (
+                    stripe_id, subscription_id, price_id, quantity, metadata
+                )
+                SELECT stripe_id, subscription_id, price_id, quantity, metadata
+                FROM si_stage
+                ON CONFLICT (stripe_id) DO NOTHING
+            """)
+            conn.commit()
+            inserted += len(rows)
+            rows.clear()
+            logger.info(f"Committed batch; {inserted} items inserted so far")
+
+        def backfill_items(subscription, subscription_db_id):
+            nonlocal skipped
+            for item in subscription['items']['data']:
+                if item.get('id') in existing:
+                    continue
+                price_stripe_id = item.get('price', {}).get('id')
+                if not price_stripe_id:
+                    continue
+                price_db_id = price_map.get(price_stripe_id)
+                if price_db_id is None:
+                    logger.warning(f"Price {price_stripe_id} not synced; skipping item {item.get('id')}")
+                    skipped += 1
+                    continue
+
+                rows.append((
+                    item.get('id'),
+                    subscription_db_id,
+                    price_db_id,
+                    item.get('quantity', 1),
+                    orjson.dumps(item.get('metadata', {}), default=str).decode()
+                ))
+                logger.debug(f"Queued item {item.get('id')} for subscription {subscription.id}")
+
+        # Producer/consumer split: a thread walks Stripe's pages and feeds
+        # matches into a bounded queue while this thread serializes rows
+        # and writes, so the network wait overlaps the DB work
+        unmatched = dict(missing)
+        work_queue = queue.Queue(maxsize=1000)
+        _DONE = object()
+
+        def producer():
+            try:
+                subscriptions = stripe.Subscription.list(
+                    limit=100, status='all', expand=['data.items.data.price']
+                )
+                for subscription in subscriptions.auto_paging_iter():
+                    subscription_db_id = unmatched.pop(subscription.id, None)
+                    if subscription_db_id is None:
+                        continue
+                    work_queue.put((subscription, subscription_db_id))
+            except Exception as e:
+                logger.warning(f"Stripe pagination stopped early: {e}")
+            finally:
+                work_queue.put(_DONE)
+
+        threading.Thread(target=producer, name='backfill-producer',
+                         daemon=True).start()
+        while True:
+            task = work_queue.get()
+            if task is _DONE:
+                break
+            subscription, subscription_db_id = task
+            backfill_items(subscription, subscription_db_id)
+            processed += 1
+            if processed % 500 == 0:
+                flush_rows()
+
+        # Anything the list didn't return has to be retrieved individually;
+        # those fetches are pure network waits, so run them concurrently and
+        # keep the DB writes on this thread
+        if unmatched:
+            print(f"📥 {len(unmatched)} subscriptions not in list; retrieving individually...")
+
+            def fetch(stripe_sub_id):
+                try:
+                    return stripe_sub_id, stripe.Subscription.retrieve(
+                        stripe_sub_id, expand=['items.data.price'])
+                except Exception as e:
+                    return stripe_sub_id, e
+
+            failures = []
+            with ThreadPoolExecutor(max_workers=32) as executor:
+                for stripe_sub_id, result in executor.map(fetch, list(unmatched)):
+                    if isinstance(result, Exception):
+                        failures.append((stripe_sub_id, result))
+                    else:
+                        backfill_items(result, unmatched[stripe_sub_id])
+
+            # Retry the dead-letter list with exponential back-off so a
+            # transient rate limit or blip doesn't drop subscriptions
+            for attempt in range(1, 4):
+                if not failures:
+                    break
+                time.sleep(min(2 ** attempt, 30))
+                logger.info(f"Retrying {len(failures)} failed retrieves (attempt {attempt})")
+                retry_list, failures = failures, []
+                for stripe_sub_id, _ in retry_list:
+                    stripe_sub_id, result = fetch(stripe_sub_id)
+                    if isinstance(result, Exception):
+                        failures.append((stripe_sub_id, result))
+                    else:
+                        backfill_items(result, unmatched[stripe_sub_id])
+
+            # Anything still failing is persisted for triage instead of
+            # scrolling away on stdout
+            if failures:
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS backfill_errors (
+                        id SERIAL PRIMARY KEY,
+                        stripe_id VARCHAR(255) NOT NULL,
+                        error TEXT,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                    )
+                """)
+                cur.executemany(
+                    "INSERT INTO backfill_errors (stripe_id, error) VALUES (%s, %s)",
+                    [(stripe_sub_id, str(error)) for stripe_sub_id, error in failures])
+                logger.warning(f"{len(failures)} subscriptions recorded in backfill_errors")
+
+        flush_rows()
+        print(f"\n✅ Backfill completed: {inserted} items inserted, {skipped} skipped")
+
+    except Exception as e:
+        conn.rollback()
+        print(f"❌ Error backfilling subscription items: {e}")
+    finally:
+        # Restore full durability before the connection goes back to the pool
+        try:
+            with conn.cursor() as reset_cur:
+                reset_cur.execute("RESET synchronous_commit")
+            conn.commit()
+        except Exception:
+            pass
+        cur.close()
+        release_db_connection(conn)
 
 def reset_database():
     """Reset database to initial state"""
@@ -337,7 +594,7 @@ def reset_database():
         print(f"❌ Error resetting database: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def create_admin_user():
     """Create admin user"""
@@ -382,57 +639,58 @@ def create_admin_user():
         print(f"❌ Error creating admin user: {e}")
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def backup_data():
-    """Backup database data to JSON file"""
+    """Backup database data to an NDJSON file, streamed table by table
+
+    Each table is announced with a {"__table__": name} header line and
+    followed by one JSON object per row, so restores can read the file
+    line by line and memory stays bounded by the cursor batch size
+    instead of the database size.
+    """
     print("💾 Backing up database data...")
-    
+
     conn = get_db_connection()
-    cur = conn.cursor()
     try:
-        backup_data = {}
-        
         # Get list of tables
-        cur.execute("""
-            SELECT table_name
-            FROM information_schema.tables
-            WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
-            ORDER BY table_name;
-        """)
-        tables = [row['table_name'] for row in cur.fetchall()]
-        
-        # Backup each table
-        for table in tables:
-            try:
-                cur.execute(f"SELECT * FROM {table}")
-                rows = cur.fetchall()
-                # Convert to list of dicts for JSON serialization
-                backup_data[table] = [dict(row) for row in rows]
-                print(f"✅ Backed up table: {table} ({len(rows)} rows)")
-            except Exception as e:
-                print(f"❌ Error backing up table {table}: {e}")
-        
-        # Save to file
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT table_name
+                FROM information_schema.tables
+                WHERE table_schema = 'public' AND table_type = 'BASE TABLE'
+                ORDER BY table_name;
+            """)
+            tables = [row['table_name'] for row in cur.fetchall()]
+
         timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"backup_{timestamp}.json"
-        
-        # Custom JSON encoder for datetime objects
-        def json_serializer(obj):
-            if isinstance(obj, datetime):
-                return obj.isoformat()
-            raise TypeError(f"Object of type {type(obj)} is not JSON serializable")
-        
-        with open(filename, 'w') as f:
-            json.dump(backup_data, f, indent=2, default=json_serializer)
-        
+        filename = f"backup_{timestamp}.ndjson"
+
+        with open(filename, 'wb') as f:
+            for table in tables:
+                try:
+                    # Server-side cursor streams rows in batches instead
+                    # of materializing whole tables in memory
+                    with conn.cursor(name=f'backup_{table}') as cur:
+                        cur.itersize = 5000
+                        cur.execute(f"SELECT * FROM {table}")
+                        f.write(orjson.dumps({'__table__': table}) + b'\n')
+                        row_count = 0
+                        for row in cur:
+                            f.write(orjson.dumps(row, option=orjson.OPT_NAIVE_UTC, default=str) + b'\n')
+                            row_count += 1
+                    print(f"✅ Backed up table: {table} ({row_count} rows)")
+                except Exception as e:
+                    conn.rollback()
+                    print(f"❌ Error backing up table {table}: {e}")
+        conn.commit()
+
         print(f"✅ Backup completed: {filename}")
-        
+
     except Exception as e:
         print(f"❌ Error creating backup: {e}")
     finally:
-        cur.close()
-        conn.close()
+        release_db_connection(conn)
 
 def check_app_syntax():
     """Check Flask app for syntax errors"""
@@ -486,7 +744,7 @@ def test_database_connection():
             print(f"   ⚠️  app_users table issue: {e}")
         
         cur.close()
-        conn.close()
+        release_db_connection(conn)
         
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
@@ -542,6 +800,8 @@ def main():
         show_table_stats()
     elif args.command == 'sync-stripe':
         sync_stripe_data()
+    elif args.command == 'sync-subscription-items':
+        sync_subscription_items()
     elif args.command == 'reset-database':
         reset_database()
     elif args.command == 'create-admin':
@@ -20,5 +20,5 @@ if [ ! -f ".env" ]; then
     exit 1
 fi
 
-# Start the Flask application
-python3 app.py
+# Start the application behind gunicorn with gevent workers
+gunicorn -k gevent -w 2 --worker-connections 200 -b 0.0.0.0:4242 wsgi:app
@@ -31,12 +31,7 @@ CREATE TABLE customers (
     email VARCHAR(255) NOT NULL,
     name VARCHAR(255),
     phone VARCHAR(50),
-    address_line1 VARCHAR(255),
-    address_line2 VARCHAR(255),
-    address_city VARCHAR(100),
-    address_state VARCHAR(100),
-    address_postal_code VARCHAR(20),
-    address_country CHAR(2),
+    address JSONB, -- Stripe address object (line1, line2, city, state, postal_code, country)
     currency CHAR(3),
     balance INTEGER DEFAULT 0,
     tax_exempt VARCHAR(20) DEFAULT 'none',
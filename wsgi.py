@@ -0,0 +1,18 @@
+"""
+Production WSGI entrypoint for the Stripe integration server.
+
+Runs the app under gunicorn with gevent workers:
+
+    gunicorn -k gevent -w 2 --worker-connections 200 wsgi:app
+
+psycopg2 is monkey-patched before the app module is imported so the
+connection pool is created on green-thread-aware sockets, letting DB and
+Stripe/requests IO yield instead of blocking the worker.
+"""
+from psycogreen.gevent import patch_psycopg
+
+patch_psycopg()
+
+from app import app, _bootstrap_schema
+
+_bootstrap_schema()